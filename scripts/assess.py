@@ -0,0 +1,609 @@
+'''
+Scores predicted segmentations against the labels of a cityscapes format
+dataset. Prediction PNGs (class id per pixel, named like the labels) are
+walked in lockstep with ann_dir/<split>, and each pair is reduced to a
+confusion matrix in a process pool, so memory stays bounded whatever the
+dataset size. The summed matrix gives per-class IoU, mIoU and pixel accuracy.
+
+Any number of prediction directories (models) can be given at once. Each
+label image is then decoded only once and scored against all of them, and
+the per-image scores of every model can be written out as a CSV breakdown.
+
+Thin classes like vines barely move the IoU when their edges are wrong, so
+boundary precision, recall and F1 can also be tracked for chosen classes. A
+predicted boundary pixel is correct if it is within a tolerance of a label
+boundary pixel, and the other way around for recall. Boundaries come from a
+morphological erosion and the distances from distance transforms, so each
+image is a few whole-image operations.
+
+Every image's counts are cached under the content hashes of its label and
+prediction (and the scoring settings), so re-running after only some
+predictions changed only decodes and counts those, and the totals are summed
+back up from the cache.
+'''
+
+import argparse
+from contextlib import nullcontext
+import csv
+import cv2
+import hashlib
+import json
+import logging
+from multiprocessing import Pool
+import numpy
+import os
+from pathlib import Path
+
+from scripts import profiling
+
+
+# Number of classes, label values at or above this are ignored
+NUM_CLASSES = 6
+# Distance in pixels within which boundary pixels count as matching
+TOLERANCE = 2
+# Subdirectories of the cache directory, see load_cache
+HASH_DIR = "hashes"
+COUNT_DIR = "counts"
+
+
+def main(preddirs, datapath, split="val", num_classes=NUM_CLASSES,
+         workers=None, output=None, per_image=None, boundary_classes=(),
+         tolerance=TOLERANCE, cachedir=None):
+
+    names = model_names(preddirs)
+    sets = image_sets(preddirs, datapath.joinpath("ann_dir", split))
+    logging.info(f"Assessing {len(sets)} images from {len(preddirs)} models")
+    cache = None if cachedir is None else load_cache(cachedir)
+    confusion, boundary = dataset_confusion(sets, num_classes, workers, names,
+                                            per_image, boundary_classes,
+                                            tolerance, cache)
+
+    results = {}
+    for name, matrix, counts in zip(names, confusion, boundary):
+        results[name] = metrics(matrix, counts, boundary_classes)
+        log_metrics(results[name], f"{name}: ")
+
+    if output is not None:
+        json.dump(results, output.open("w"), indent=4)
+        logging.info(f"Saved results to {output}")
+    return results
+
+
+def model_names(preddirs):
+    '''Name each model by its prediction directory, the full path if the
+    directory names alone would clash.'''
+    names = [preddir.name for preddir in preddirs]
+    if len(set(names)) < len(names):
+        names = [str(preddir) for preddir in preddirs]
+    return names
+
+
+def image_sets(preddirs, anndir):
+    '''
+    Match every label image with the prediction of the same name in each of
+    the prediction directories.
+
+    Returns: sorted list of (label path, [prediction path per model]) tuples
+    '''
+    sets = []
+    for annpath in sorted(anndir.glob("*png")):
+        predpaths = [preddir.joinpath(annpath.name) for preddir in preddirs]
+        for predpath in predpaths:
+            assert predpath.is_file(), f"No prediction {predpath} for {annpath}"
+        sets.append((annpath, predpaths))
+    return sets
+
+
+def dataset_confusion(sets, num_classes=NUM_CLASSES, workers=None,
+                      names=None, per_image=None, boundary_classes=(),
+                      tolerance=TOLERANCE, cache=None):
+    '''
+    Sum the confusion matrices of every model over the dataset, decoding and
+    counting in a process pool. Only a few images are in memory at a time,
+    and the parent only ever holds the running totals (the per-image scores
+    are written out as they come in). With a cache, only the (label,
+    prediction) pairs it doesn't have counts for are decoded and counted,
+    and each image's new counts are saved to it as soon as they come in, so
+    an interrupted run keeps what it counted.
+
+    Arguments:
+        sets: output of image_sets
+        num_classes: K
+        workers: number of processes, all cores if None
+        names: name of each model, for the per-image breakdown, from the
+            prediction directories (see model_names) if None
+        per_image: optional path of a CSV to write per-image scores to
+        boundary_classes: classes to count boundary matches for
+        tolerance: see TOLERANCE
+        cache: optional dict from load_cache
+
+    Returns: two-element tuple of
+        [0]: (N, K, K) int64 matrices, [model, truth, prediction] pixel counts
+        [1]: (N, B, 4) int64 boundary counts for each model and boundary
+            class, see boundary_counts
+    '''
+    if names is None:
+        names = model_names([predpath.parent for predpath in sets[0][1]]) \
+            if len(sets) > 0 else []
+    number = len(names)
+    confusion = numpy.zeros((number, num_classes, num_classes),
+                            dtype=numpy.int64)
+    boundary = numpy.zeros((number, len(boundary_classes), 4),
+                           dtype=numpy.int64)
+
+    # Work out which models' counts each image still needs
+    settings = [num_classes, list(boundary_classes), tolerance]
+    keys = []
+    missing = []
+    for annpath, predpaths in sets:
+        if cache is None:
+            keys.append([None] * len(predpaths))
+            missing.append(list(range(len(predpaths))))
+            continue
+        label_hash = cached_hash(cache, annpath)
+        keys.append([pair_key(label_hash, cached_hash(cache, predpath),
+                              settings)
+                     for predpath in predpaths])
+        missing.append([i for i, key in enumerate(keys[-1])
+                        if not count_path(cache, key).is_file()])
+    if cache is not None:
+        # All the hashing is done up front, so save it before counting
+        save_hashes(cache)
+    jobs = [(annpath, [predpaths[i] for i in todo], num_classes,
+             boundary_classes, tolerance)
+            for (annpath, predpaths), todo in zip(sets, missing) if todo]
+    logging.info(f"Counting {len(jobs)} images,"
+                 f" {len(sets) - len(jobs)} fully cached")
+
+    outfile = None
+    if per_image is not None:
+        outfile = per_image.open("w", newline="")
+        writer = csv.writer(outfile)
+        writer.writerow(["image", "model", "pixel_accuracy", "miou"]
+                        + [f"iou_{classid}" for classid in range(num_classes)]
+                        + [f"boundary_f1_{classid}"
+                           for classid in boundary_classes])
+
+    with Pool(workers) if jobs else nullcontext() as pool:
+        # imap keeps the jobs in order, so they can be matched back up with
+        # the images that needed them
+        computed = iter(()) if pool is None else \
+            pool.imap(confusion_job, jobs, chunksize=4)
+        for i, ((annpath, predpaths), image_keys, todo) in \
+                enumerate(zip(sets, keys, missing)):
+            matrices = numpy.zeros((number, num_classes, num_classes),
+                                   dtype=numpy.int64)
+            counts = numpy.zeros((number, len(boundary_classes), 4),
+                                 dtype=numpy.int64)
+            if todo:
+                _, new_matrices, new_counts, stages = next(computed)
+                profiling.merge(stages)
+                matrices[todo] = new_matrices
+                counts[todo] = new_counts
+                if cache is not None:
+                    for j, matrix, count in zip(todo, new_matrices,
+                                                new_counts):
+                        save_counts(cache, image_keys[j], matrix, count)
+            for j in range(number):
+                if j not in todo:
+                    matrix, count = load_counts(cache, image_keys[j])
+                    matrices[j] = matrix
+                    counts[j] = numpy.reshape(count, counts[j].shape)
+
+            confusion += matrices
+            boundary += counts
+            if outfile is not None:
+                for row in zip(names, matrices, counts):
+                    writer.writerow(breakdown_row(annpath.name, *row,
+                                                  boundary_classes))
+            if i % 50 == 0:
+                logging.info(f"Counted {i + 1}/{len(sets)} images")
+
+    if outfile is not None:
+        outfile.close()
+        logging.info(f"Saved per-image scores to {per_image}")
+    return confusion, boundary
+
+
+def load_cache(cachedir):
+    '''
+    Start using the per-image count cache in cachedir. It is split up so a
+    run only reads and writes the entries it needs:
+        hashes/<directory hash>.json: {file name: [mtime_ns, size, sha256]}
+            for the files of one directory, so files that haven't been
+            touched aren't hashed again. Entries of files that no longer
+            exist are dropped whenever the directory's shard is saved.
+        counts/<key[:2]>/<pair_key>.json: [(K, K) confusion, (B, 4) boundary
+            counts] of one (label, prediction, settings) pair. Every entry
+            is a separate file, so any of them can be deleted to free space.
+
+    Returns: dict of the cache directory and the hash shards loaded so far
+    '''
+    return {"dir": cachedir, "hashes": {}}
+
+
+def hash_shard(cache, directory):
+    '''The recorded hashes of one directory's files, loaded on first use.'''
+    key = str(directory.absolute())
+    if key not in cache["hashes"]:
+        path = hash_path(cache, key)
+        cache["hashes"][key] = json.load(path.open("r")) \
+            if path.is_file() else {}
+    return cache["hashes"][key]
+
+
+def cached_hash(cache, path):
+    '''Content hash of a file, reused from the cache if the file's mtime
+    and size haven't changed since it was hashed.'''
+    stat = path.stat()
+    shard = hash_shard(cache, path.parent)
+    known = shard.get(path.name)
+    if known is not None and known[:2] == [stat.st_mtime_ns, stat.st_size]:
+        return known[2]
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    shard[path.name] = [stat.st_mtime_ns, stat.st_size, digest]
+    return digest
+
+
+def save_hashes(cache):
+    '''Write back the hash shards that have been loaded, minus any files
+    that have since been deleted.'''
+    for directory, shard in cache["hashes"].items():
+        for name in [name for name in shard
+                     if not Path(directory, name).is_file()]:
+            del shard[name]
+        atomic_dump(shard, hash_path(cache, directory))
+
+
+def hash_path(cache, directory):
+    '''Where the hashes of one (absolute path string) directory's files go
+    in the cache.'''
+    name = hashlib.sha256(directory.encode()).hexdigest()
+    return cache["dir"].joinpath(HASH_DIR, f"{name}.json")
+
+
+def count_path(cache, key):
+    '''Where the counts of one pair key go in the cache.'''
+    return cache["dir"].joinpath(COUNT_DIR, key[:2], f"{key}.json")
+
+
+def load_counts(cache, key):
+    '''Returns: (K, K) confusion and (B, 4) boundary counts as lists'''
+    return json.load(count_path(cache, key).open("r"))
+
+
+def save_counts(cache, key, matrix, counts):
+    '''Save the counts of one pair key, see load_cache.'''
+    atomic_dump([matrix.tolist(), counts.tolist()], count_path(cache, key))
+
+
+def atomic_dump(value, path):
+    '''Write JSON through a temporary file, so an interrupted run can't leave
+    it half written.'''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with temp_path.open("w") as outfile:
+        json.dump(value, outfile)
+    temp_path.replace(path)
+
+
+def pair_key(label_hash, prediction_hash, settings):
+    '''Cache key of one (label, prediction) pair scored with settings.'''
+    return hashlib.sha256(
+        json.dumps([label_hash, prediction_hash, settings]).encode()
+    ).hexdigest()
+
+
+def breakdown_row(image, model, matrix, counts, boundary_classes=()):
+    '''One CSV row of per-image scores, blank where they're undefined.'''
+    def value(number):
+        return "" if number is None else f"{number:.4f}"
+
+    results = metrics(matrix, counts, boundary_classes)
+    return ([image, model, value(results["pixel_accuracy"]),
+             value(results["miou"])]
+            + [value(iou) for iou in results["iou"]]
+            + [value(results["boundary"][str(classid)]["f1"])
+               for classid in boundary_classes])
+
+
+def confusion_job(job):
+    '''
+    Decode one label image once, and count its confusion matrix against the
+    prediction of every model.
+
+    Arguments:
+        job: (label path, [prediction path per model], number of classes,
+              boundary classes, tolerance)
+
+    Returns: (image name, (N, K, K) int64 matrices, (N, B, 4) int64 boundary
+        counts, profiling stages of the job)
+    '''
+    annpath, predpaths, num_classes, boundary_classes, tolerance = job
+    with profiling.stage("decode"):
+        truth = cv2.imread(str(annpath), cv2.IMREAD_UNCHANGED)
+    with profiling.stage("count"):
+        valid, offsets = label_offsets(truth, num_classes)
+    with profiling.stage("boundary"):
+        # The label boundaries and distances to them are shared by all models
+        label_sides = [boundary_distance(truth == classid)
+                       for classid in boundary_classes]
+
+    matrices = numpy.zeros((len(predpaths), num_classes, num_classes),
+                           dtype=numpy.int64)
+    counts = numpy.zeros((len(predpaths), len(boundary_classes), 4),
+                         dtype=numpy.int64)
+    for i, predpath in enumerate(predpaths):
+        with profiling.stage("decode"):
+            predicted = cv2.imread(str(predpath), cv2.IMREAD_UNCHANGED)
+        with profiling.stage("count"):
+            matrices[i] = count_predictions(valid, offsets, predicted,
+                                            num_classes)
+        with profiling.stage("boundary"):
+            for j, classid in enumerate(boundary_classes):
+                counts[i, j] = boundary_counts(label_sides[j],
+                                               predicted == classid,
+                                               valid,
+                                               tolerance)
+    return annpath.name, matrices, counts, profiling.collect()
+
+
+def boundary_distance(mask):
+    '''
+    Find the boundary of a class mask, the mask pixels with a neighbor
+    (8-connected) outside it, and the distance from every pixel to it.
+
+    Arguments:
+        mask: (H, W) bool mask of one class
+
+    Returns: (H, W) bool boundary mask, (H, W) float32 distance in pixels to
+        the nearest boundary pixel (large everywhere if there is none)
+    '''
+    mask = mask.astype(numpy.uint8)
+    # Erosion treats outside the image as inside the mask, so the image edge
+    # doesn't count as a boundary
+    boundary = (mask - cv2.erode(mask, numpy.ones((3, 3), numpy.uint8))) > 0
+    # distanceTransform measures to the nearest zero pixel
+    distance = cv2.distanceTransform((~boundary).astype(numpy.uint8),
+                                     cv2.DIST_L2,
+                                     cv2.DIST_MASK_PRECISE)
+    return boundary, distance
+
+
+def boundary_counts(label_side, predicted_mask, valid, tolerance=TOLERANCE):
+    '''
+    Count boundary matches of one class in one image. Predicted boundary
+    pixels where the label is ignored don't count.
+
+    Arguments:
+        label_side: boundary_distance output for the label mask
+        predicted_mask: (H, W) bool mask of the class in the prediction
+        valid: (H, W) bool mask of pixels with a usable label
+        tolerance: see TOLERANCE
+
+    Returns: (4,) int64 array of
+        [matched predicted boundary pixels, predicted boundary pixels,
+         matched label boundary pixels, label boundary pixels]
+    '''
+    label_boundary, label_distance = label_side
+    predicted_boundary, predicted_distance = boundary_distance(predicted_mask)
+    predicted_boundary &= valid
+    return numpy.array([
+        numpy.count_nonzero(label_distance[predicted_boundary] <= tolerance),
+        numpy.count_nonzero(predicted_boundary),
+        numpy.count_nonzero(predicted_distance[label_boundary] <= tolerance),
+        numpy.count_nonzero(label_boundary),
+    ])
+
+
+def confusion_matrix(truth, predicted, num_classes=NUM_CLASSES):
+    '''
+    Count every (truth, prediction) pair of classes with a single bincount
+    over truth * K + prediction. Pixels whose label is num_classes or above
+    (like cityscapes' 255) are ignored.
+
+    Arguments:
+        truth: (H, W) integer label image
+        predicted: (H, W) integer predicted class image
+        num_classes: K
+
+    Returns: (K, K) int64 matrix, [truth, prediction] pixel counts
+    '''
+    valid, offsets = label_offsets(truth, num_classes)
+    return count_predictions(valid, offsets, predicted, num_classes)
+
+
+def label_offsets(truth, num_classes=NUM_CLASSES):
+    '''
+    The label half of confusion_matrix, which only needs doing once however
+    many predictions are scored against the label image.
+
+    Returns: (H, W) bool mask of the pixels that count, and truth * K for
+        those pixels
+    '''
+    valid = truth < num_classes
+    return valid, truth[valid].astype(numpy.int64) * num_classes
+
+
+def count_predictions(valid, offsets, predicted, num_classes=NUM_CLASSES):
+    '''The prediction half of confusion_matrix, see label_offsets.'''
+    assert valid.shape == predicted.shape, \
+        f"Label {valid.shape} and prediction {predicted.shape} don't match"
+    # Only the pixels that count have to be in range, ignored label pixels
+    # can be predicted as anything
+    predicted = predicted[valid]
+    assert predicted.size == 0 or predicted.max() < num_classes, \
+        f"Predicted class {predicted.max()} is out of range"
+    return numpy.bincount(offsets + predicted,
+                          minlength=num_classes**2) \
+        .reshape(num_classes, num_classes)
+
+
+def metrics(confusion, boundary=None, boundary_classes=()):
+    '''
+    Turn a confusion matrix into segmentation metrics. Classes that appear in
+    neither the labels nor the predictions have no IoU (None) and are left
+    out of the mIoU.
+
+    Arguments:
+        confusion: (K, K) matrix, [truth, prediction] pixel counts
+        boundary: (B, 4) boundary counts, see boundary_counts
+        boundary_classes: the B classes the boundary counts are for
+
+    Returns: dict of "iou" (per class list), "miou", "pixel_accuracy",
+        "pixels" and "boundary" ({class: precision, recall, f1})
+    '''
+    hits = numpy.diag(confusion).astype(float)
+    union = confusion.sum(axis=0) + confusion.sum(axis=1) - hits
+    iou = numpy.full(len(hits), numpy.nan)
+    numpy.divide(hits, union, out=iou, where=union > 0)
+    total = confusion.sum()
+    return {
+        "iou": [None if numpy.isnan(value) else float(value) for value in iou],
+        "miou": float(numpy.nanmean(iou)) if (union > 0).any() else None,
+        "pixel_accuracy": float(hits.sum() / total) if total > 0 else None,
+        "pixels": int(total),
+        "boundary": {
+            str(classid): boundary_metrics(*counts)
+            for classid, counts in zip(boundary_classes, boundary)
+        },
+    }
+
+
+def boundary_metrics(predicted_hits, predicted, label_hits, label):
+    '''Boundary precision, recall and F1 from boundary_counts, None where
+    there were no boundary pixels to score.'''
+    precision = predicted_hits / predicted if predicted > 0 else None
+    recall = label_hits / label if label > 0 else None
+    f1 = None
+    if precision is not None and recall is not None:
+        f1 = 0.0
+        if precision + recall > 0:
+            f1 = 2 * precision * recall / (precision + recall)
+    return {"precision": precision, "recall": recall, "f1": f1}
+
+
+def log_metrics(results, name=""):
+    '''Log the output of metrics as a small table.'''
+    def percent(value):
+        return "   n/a" if value is None else f"{100 * value:6.2f}"
+
+    for classid, value in enumerate(results["iou"]):
+        logging.info(f"{name}class {classid} IoU {percent(value)}")
+    logging.info(f"{name}mIoU           {percent(results['miou'])}")
+    logging.info(f"{name}pixel accuracy {percent(results['pixel_accuracy'])}"
+                 f" over {results['pixels']} pixels")
+    for classid, scores in results["boundary"].items():
+        logging.info(f"{name}class {classid} boundary"
+                     f" P {percent(scores['precision'])}"
+                     f" R {percent(scores['recall'])}"
+                     f" F1 {percent(scores['f1'])}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-b", "--boundary-classes",
+        help="Classes to also score boundary precision/recall/F1 for, e.g. 1"
+             " for vines.",
+        nargs="*",
+        default=[],
+        type=int,
+    )
+    parser.add_argument(
+        "-c", "--cache-dir",
+        help="Directory to cache per-image counts in, keyed by the content of"
+             " the label and prediction, so re-runs only count what changed.",
+        default=Path("/tmp/assess_cache/"),
+        type=Path,
+    )
+    parser.add_argument(
+        "-d", "--data-path",
+        help="Base folder in the cityscapes format with the label images.",
+        required=True,
+        type=Path,
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Count every image from scratch and don't touch the cache.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-n", "--num-classes",
+        help="Number of classes, label values at or above this are ignored.",
+        default=NUM_CLASSES,
+        type=int,
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="Optional JSON file to save the results in.",
+        default=None,
+        type=Path,
+    )
+    parser.add_argument(
+        "-i", "--per-image",
+        help="Optional CSV file to save every image's scores for every model"
+             " in.",
+        default=None,
+        type=Path,
+    )
+    parser.add_argument(
+        "-p", "--pred-dirs",
+        help="Directories of predicted class id PNGs, named like the labels."
+             " Give several to compare models in one pass over the labels.",
+        nargs="+",
+        required=True,
+        type=Path,
+    )
+    parser.add_argument(
+        "-s", "--split",
+        help="Which ann_dir split to assess against.",
+        default="val",
+    )
+    parser.add_argument(
+        "-t", "--tolerance",
+        help="Distance in pixels within which boundary pixels match.",
+        default=TOLERANCE,
+        type=float,
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of processes to decode and count images with. Uses all"
+             " cores if not given.",
+        type=int,
+        default=None,
+    )
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    for pred_dir in args.pred_dirs:
+        assert pred_dir.is_dir(), f"{pred_dir} was not findable"
+    assert args.data_path.joinpath("ann_dir", args.split).is_dir()
+
+    return args
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    args = parse_args()
+    profiling.start("assess", args.profile, args.cprofile)
+    main(preddirs=args.pred_dirs,
+         datapath=args.data_path,
+         split=args.split,
+         num_classes=args.num_classes,
+         workers=args.workers,
+         output=args.output,
+         per_image=args.per_image,
+         boundary_classes=args.boundary_classes,
+         tolerance=args.tolerance,
+         cachedir=None if args.no_cache else args.cache_dir)
+    profiling.finish()
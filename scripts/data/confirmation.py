@@ -10,6 +10,8 @@ from pathlib import Path
 import subprocess
 import tempfile
 
+from scripts import profiling
+
 
 def main(anndir, imgdir, out, gif, video):
 
@@ -27,15 +29,17 @@ def main(anndir, imgdir, out, gif, video):
         impath = imgdir.joinpath(annpath.name)
         assert impath.is_file()
         if gif:
-            save_gif(cv2.imread(str(impath)),
-                     cv2.imread(str(annpath)),
-                     out,
-                     impath.name)
+            with profiling.stage("decode"):
+                img = cv2.imread(str(impath))
+                ann = cv2.imread(str(annpath))
+            with profiling.stage("gif"):
+                save_gif(img, ann, out, impath.name)
             print(f"Saved {impath.name} as gif")
         if video:
-            processed_img, processed_ann = videoify(impath, annpath)
-            writer.write(processed_img)
-            writer.write(processed_ann)
+            with profiling.stage("video"):
+                processed_img, processed_ann = videoify(impath, annpath)
+                writer.write(processed_img)
+                writer.write(processed_ann)
 
     if video:
         cv2.destroyAllWindows()
@@ -114,6 +118,7 @@ def parse_args():
         help="Make video outputs for the images.",
         action="store_true",
     )
+    profiling.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -122,8 +127,10 @@ if __name__ == "__main__":
     assert args.gif or args.video, "Flags weren't set to give any output"
     for directory in (args.annotations_dir, args.img_dir, args.output_dir):
         assert directory.is_dir(), f"{directory} was not findable"
+    profiling.start("confirmation", args.profile, args.cprofile)
     main(anndir=args.annotations_dir,
          imgdir=args.img_dir,
          out=args.output_dir,
          gif=args.gif,
          video=args.video)
+    profiling.finish()
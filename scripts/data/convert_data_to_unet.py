@@ -4,6 +4,8 @@ import logging
 import numpy
 from pathlib import Path
 
+from scripts import profiling
+
 
 DIVISOR = 32
 
@@ -25,17 +27,21 @@ def main(base, save):
         if i % 25 == 0:
             logging.info(f"On iteration {i}")
 
-        image = cv2.imread(str(impath), cv2.IMREAD_UNCHANGED)
+        with profiling.stage("decode"):
+            image = cv2.imread(str(impath), cv2.IMREAD_UNCHANGED)
+
+        with profiling.stage("pad"):
+            # We want to pad things to be divisible by DIVISOR for Unet
+            pad_width = ((0, pad_size(image.shape[0])),
+                         (0, pad_size(image.shape[1])))
+            if len(image.shape) == 3:
+                pad_width += ((0, 0), )
 
-        # We want to pad things to be divisible by DIVISOR for Unet
-        pad_width = ((0, pad_size(image.shape[0])),
-                     (0, pad_size(image.shape[1])))
-        if len(image.shape) == 3:
-            pad_width += ((0, 0), )
+            image = numpy.pad(array=image, pad_width=pad_width)
 
-        image = numpy.pad(array=image, pad_width=pad_width)
-        savepath = save.joinpath(impath.relative_to(base))
-        cv2.imwrite(str(savepath), image)
+        with profiling.stage("save"):
+            savepath = save.joinpath(impath.relative_to(base))
+            cv2.imwrite(str(savepath), image)
 
 
 def pad_size(side):
@@ -62,6 +68,7 @@ def parse_args():
         required=True,
         type=Path,
     )
+    profiling.add_arguments(parser)
     args = parser.parse_args()
     assert args.data_path.is_dir()
     assert not args.save_dir.is_dir()
@@ -77,4 +84,6 @@ if __name__ == "__main__":
     )
 
     args = parse_args()
+    profiling.start("convert_data_to_unet", args.profile, args.cprofile)
     main(args.data_path, args.save_dir)
+    profiling.finish()
@@ -4,11 +4,21 @@ Tool to take various label output formats I've been given and turn them into
 '''
 
 import argparse
+from collections import deque
 import cv2
+from functools import lru_cache
+from glob import glob
+import hashlib
 import json
-from matplotlib import pyplot
+from multiprocessing import Pool
 import numpy
+import os
 from pathlib import Path
+import re
+
+from scripts import profiling
+from scripts.data.visualize import palette, save_paletted
+from scripts.parallel import bounded_imap
 
 
 SIZE = (2048, 2448)
@@ -21,95 +31,788 @@ CLASSES = {
     "sign": 5,
 }
 
+# Debug images mark polygon points with this value, which also gets the last
+# color of the colormap
+VIS_POINTS = max(CLASSES.values()) + 1
+VIS_COLORMAP = "viridis"
+
+# How much of a JSON export to read at a time when streaming through it
+CHUNK_SIZE = 2**20
+# What scan_json looks for to follow a JSON value's nesting: characters that
+# open or close strings and brackets, the end of a string or an escape in it,
+# and the end of a number, true, false or null
+STRUCTURE = re.compile(r'[][{}"]')
+STRING_END = re.compile(r'["\\]')
+SCALAR_END = re.compile(r'[\s,\]}]')
+WHITESPACE = " \t\r\n"
+
+# Bump this whenever a change to the converters alters the label images they
+# write, so batch runs know to rebuild everything in an older manifest.
+CONVERTER_VERSION = 4
+MANIFEST_NAME = "manifest.json"
+STORE_DIR = "polygons"
+
+# Background regions up to this many pixels that are completely surrounded by
+# vine get filled in as vine by fill_enclosed_gaps
+MAX_HOLE_AREA = 5000
+
+# Bump this when the polygon store layout, or what goes into it, changes
+STORE_VERSION = 1
+# Export types that can be compiled into a polygon store
+POLYGON_TYPES = ("coco-json", "diffgram-json", "H-json", "F-json")
+
+
 def main(args):
+    if args.batch is None:
+        convert(args.input_file,
+                args.file_type,
+                args.output_path,
+                args.colors_file,
+                args.workers,
+                args.max_hole_area,
+                args.store)
+    else:
+        batch(args.batch,
+              args.output_path,
+              args.file_type,
+              args.colors_file,
+              args.workers,
+              args.max_hole_area)
+
+
+def convert(input_file, file_type, output_path, colors_file=None, workers=None,
+            max_hole_area=MAX_HOLE_AREA, store=None):
+    '''
+    Turn one export into label images (plus _vis debug images). If a store
+    directory is given, polygon exports are compiled into it first (unless it
+    is already up to date) and rasterized from there.
+
+    Returns: list of the label image paths that were written
+    '''
+
+    if store is not None and file_type in POLYGON_TYPES:
+        if not store_is_current(store, input_file, file_type):
+            with profiling.stage("compile"):
+                compile_store(input_file, file_type, store)
+        input_file = store
+        file_type = "polygon-store"
 
-    image = numpy.ones(SIZE) * -1
+    image = new_canvas()
 
     vis_image = None
-    if args.file_type == "coco-json":
-        images = coco_label(image, args.input_file)
-    elif args.file_type == "diffgram-json":
-        images, vis_image = diffgram_label(image, args.input_file)
-    elif args.file_type == "colored-img":
-        images = label_by_color(image, args.input_file, args.colors_file)
-    elif args.file_type == "H-json":
-        images = h_json_label(image, args.input_file)
-    elif args.file_type == "F-json":
-        images = f_json_label(image, args.input_file)
-    else:
-        raise NotImplementedError()
+    # The dict converters parse and draw everything in here, the streaming
+    # ones (COCO and stores) only once their images are pulled out below
+    with profiling.stage("rasterize"):
+        if file_type == "coco-json":
+            images = coco_label(image, input_file, workers)
+        elif file_type == "diffgram-json":
+            images, vis_image = diffgram_label(image, input_file)
+        elif file_type == "colored-img":
+            images = label_by_color(image, input_file, colors_file)
+        elif file_type == "H-json":
+            images = h_json_label(image, input_file)
+        elif file_type == "F-json":
+            images = f_json_label(image, input_file)
+        elif file_type == "polygon-store":
+            images, vis_image = store_label(image, input_file, workers)
+        else:
+            raise NotImplementedError()
 
-    for name, image in images.items():
+    # Most converters hand back a dict, some stream their pairs out
+    if isinstance(images, dict):
+        images = images.items()
+    written = []
+    # For the streaming converters this is where the parsing and drawing
+    # happens
+    for name, image in profiling.profiled("rasterize", images):
         if name is None:
-            output_path = args.output_path
+            path = output_path
         else:
-            output_path = args.output_path.parent.joinpath(name)
+            path = output_path.parent.joinpath(name)
 
         # Make everything else background
         image[image < 0] = 0
         image = image.astype(numpy.uint8)
 
-        # Fill in known hand-labeled gaps. This is bad, but I tried hard and
-        # couldn't find a better way to handle self-intersections. Screw cv2's
-        # fillPoly and drawContour.
-        image = fill_known_gaps(output_path, image)
+        with profiling.stage("fill"):
+            # Self-intersecting vine polygons leave background holes behind,
+            # fill in the ones that are small and entirely surrounded by vine.
+            # Screw cv2's fillPoly and drawContour.
+            image = fill_enclosed_gaps(image, max_hole_area)
+            # Then fill in known hand-labeled gaps that the rules above miss
+            image = fill_known_gaps(path, image)
+
+        with profiling.stage("save"):
+            cv2.imwrite(str(path), image)
+            print(f"Saved to {str(path)}")
+            written.append(path)
+
+            # Then make a debug version, colored through a fixed palette so
+            # the classes look the same in every image
+            if vis_image is None or name is not None:
+                vis_image = image
+            save_paletted(str(path).replace(".png", "_vis.png"),
+                          numpy.maximum(vis_image, 0),
+                          palette(VIS_COLORMAP, VIS_POINTS))
+
+    return written
+
+
+def batch(pattern, output_dir, file_type=None, colors_file=None, workers=None,
+          max_hole_area=MAX_HOLE_AREA):
+    '''
+    Convert a whole directory (or glob) of exports into output_dir, fanned out
+    over a process pool. A manifest in output_dir records what each input was
+    converted from, and inputs whose recorded state still matches are skipped.
+    Polygon exports are also compiled into stores under output_dir/STORE_DIR,
+    so when the outputs do need rebuilding the JSON usually doesn't need to be
+    parsed again.
+
+    Arguments:
+        pattern: directory of exports, or a glob string matching them
+        output_dir: directory to write label images and the manifest into
+        file_type: force a --file-type, otherwise detected per input
+        colors_file: colors file used for any colored-img inputs
+        workers: number of processes, all cores if None
+        max_hole_area: see fill_enclosed_gaps
+    '''
+    if Path(pattern).is_dir():
+        inputs = sorted(path for path in Path(pattern).iterdir()
+                        if path.suffix.lower() in (".json", ".png"))
+    else:
+        inputs = sorted(Path(path) for path in glob(pattern))
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest_path = output_dir.joinpath(MANIFEST_NAME)
+    manifest = {}
+    if manifest_path.is_file():
+        manifest = json.load(manifest_path.open("r"))
+
+    jobs = []
+    for input_file in inputs:
+        entry = manifest.get(input_file.name)
+        if entry is not None and entry == manifest_entry(
+                    input_file,
+                    [output_dir.joinpath(name) for name in entry["outputs"]],
+                    colors_file,
+                    max_hole_area,
+                ):
+            print(f"Skipping unchanged {input_file}")
+            continue
+        jobs.append((input_file,
+                     file_type,
+                     output_dir.joinpath(f"{input_file.stem}.png"),
+                     colors_file,
+                     max_hole_area,
+                     output_dir.joinpath(STORE_DIR, f"{input_file.name}.polys")))
+    print(f"Converting {len(jobs)} of {len(inputs)} inputs")
+
+    # Nested pools aren't allowed, so each job converts with a single process
+    with Pool(workers) as pool:
+        for input_file, written, error, stages in \
+                pool.imap_unordered(batch_job, jobs):
+            profiling.merge(stages)
+            # Don't let one bad export take down the rest of the batch, it
+            # just stays out of the manifest and gets retried next time
+            if error is not None:
+                print(f"FAILED {input_file}: {error!r}")
+                continue
+            manifest[input_file.name] = manifest_entry(input_file,
+                                                       written,
+                                                       colors_file,
+                                                       max_hole_area)
+            # Write as we go so an interrupted batch keeps what it finished
+            temp_path = manifest_path.with_suffix(".tmp")
+            json.dump(manifest, temp_path.open("w"), indent=1, sort_keys=True)
+            temp_path.replace(manifest_path)
+
+
+def batch_job(job):
+    '''
+    Pool wrapper around convert.
+
+    Returns: (input_file, written paths, exception or None, profiling
+        stages) tuple
+    '''
+    input_file, file_type, output_path, colors_file, max_hole_area, store = job
+    try:
+        if file_type is None:
+            file_type = detect_file_type(input_file)
+        written = convert(input_file,
+                          file_type,
+                          output_path,
+                          colors_file,
+                          workers=1,
+                          max_hole_area=max_hole_area,
+                          store=store)
+    except Exception as error:
+        return input_file, [], error, profiling.collect()
+    return input_file, written, None, profiling.collect()
+
+
+def detect_file_type(input_file):
+    '''Guess the --file-type of an export from its extension and JSON keys.'''
+    if input_file.suffix.lower() == ".png":
+        return "colored-img"
+    # Only walk the top level keys rather than parsing exports that might be
+    # huge
+    keys = json_keys(input_file)
+    if "annotations" in keys and "images" in keys:
+        return "coco-json"
+    elif "label_map" in keys:
+        return "diffgram-json"
+    elif "shapes" in keys:
+        return "H-json"
+    elif "instances" in keys:
+        return "F-json"
+    raise ValueError(f"Could not detect the file type of {input_file}")
+
+
+def manifest_entry(input_file, outputs, colors_file=None,
+                   max_hole_area=MAX_HOLE_AREA):
+    '''
+    Everything that decides what an input converts to. If this matches the
+    recorded entry (and the outputs still exist) there's no need to rebuild.
+    '''
+    entry = {
+        "hash": file_hash(input_file),
+        "version": CONVERTER_VERSION,
+        "max_hole_area": max_hole_area,
+        "outputs": sorted(path.name for path in outputs),
+        # Both of these hand-made tables are keyed on file names
+        "known_fill": {path.name: KNOWN_FILL[path.name]
+                       for path in outputs if path.name in KNOWN_FILL},
+        "unmerged": UNMERGED.get(input_file.name),
+        # Empty right after a conversion, so deleted outputs force a rebuild
+        "missing": sorted(path.name for path in outputs if not path.is_file()),
+    }
+    if input_file.suffix.lower() == ".png":
+        entry["colors_hash"] = file_hash(colors_file)
+    # Round trip so tuples compare equal to what was read back from JSON
+    return json.loads(json.dumps(entry))
+
+
+def iter_json_array(json_file, key, nested=False):
+    '''
+    Stream the elements of the array stored under a top level key of a JSON
+    file one at a time, reading the file in CHUNK_SIZE pieces, so peak memory
+    is about one element rather than the whole export. With nested, the array
+    is instead looked for one level down, under key in any of the top level
+    objects (whatever their own keys are), and there has to be exactly one.
+    '''
+    with json_file.open("r") as infile:
+        position = {"buffer": "", "index": 0}
+        found = 0
+        for name in walk_json_keys(infile, position):
+            if not nested:
+                if name == key:
+                    yield from stream_json_array(infile, position)
+                    return
+                continue
+            if position["buffer"][position["index"]] != "{":
+                continue
+            for inner_name in walk_json_keys(infile, position):
+                if inner_name == key:
+                    found += 1
+                    assert found == 1, f"More than one {key} in {json_file}"
+                    yield from stream_json_array(infile, position)
+        if found == 0:
+            raise KeyError(f"Could not find {key} in {json_file}")
+
+
+def stream_json_array(infile, position):
+    '''Yield the elements of the JSON array at position one at a time,
+    leaving position just past the array.'''
+    buffer, index = position["buffer"], position["index"]
+    assert buffer[index] == "[", f"Expected an array in {infile.name}"
+    index += 1
+    while True:
+        buffer, index = skip_json(infile, buffer, index, WHITESPACE + ",")
+        if buffer[index] == "]":
+            position.update(buffer=buffer, index=index + 1)
+            return
+        element, buffer, index = decode_json(infile, buffer, index)
+        position.update(buffer=buffer, index=index)
+        yield element
+
+
+def read_json_value(json_file, key):
+    '''Decode just the value stored under a top level key of a JSON file.'''
+    with json_file.open("r") as infile:
+        position = {"buffer": "", "index": 0}
+        for name in walk_json_keys(infile, position):
+            if name == key:
+                return decode_json(infile, position["buffer"],
+                                   position["index"])[0]
+    raise KeyError(f"Could not find {key} in {json_file}")
+
+
+def json_keys(json_file):
+    '''The top level keys of a JSON file, found without decoding the values.'''
+    with json_file.open("r") as infile:
+        return set(walk_json_keys(infile, {"buffer": "", "index": 0}))
+
+
+def walk_json_keys(infile, position):
+    '''
+    Walk the keys of the JSON object that starts at (or after whitespace from)
+    position in an open file. position is a dict of the "buffer" read so far
+    and an "index" into it, and is shared with whoever is walking: each key
+    is yielded with position at the start of its value. Whoever is walking
+    can read the value and leave position past it, otherwise the walk skips
+    the value without decoding it. At the end position is past the object.
+    '''
+    buffer, index = skip_json(infile, position["buffer"], position["index"],
+                              WHITESPACE)
+    assert buffer[index] == "{", f"Expected an object in {infile.name}"
+    index += 1
+    while True:
+        buffer, index = skip_json(infile, buffer, index, WHITESPACE + ",")
+        if buffer[index] == "}":
+            position.update(buffer=buffer, index=index + 1)
+            return
+        key, buffer, index = decode_json(infile, buffer, index)
+        buffer, index = skip_json(infile, buffer, index, WHITESPACE)
+        assert buffer[index] == ":", f"Expected : after {key} in {infile.name}"
+        buffer, index = skip_json(infile, buffer, index + 1, WHITESPACE)
+        position.update(buffer=buffer, index=index)
+        yield key
+        if position["buffer"] is buffer and position["index"] == index:
+            _, buffer, index = scan_json(infile, buffer, index, keep=False)
+        else:
+            buffer, index = position["buffer"], position["index"]
+
+
+def skip_json(infile, buffer, index, characters):
+    '''Step past any of the given characters, reading more as needed.'''
+    while True:
+        while index < len(buffer) and buffer[index] in characters:
+            index += 1
+        if index < len(buffer):
+            return buffer, index
+        chunk = infile.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError(f"Unexpected end of {infile.name}")
+        buffer = chunk
+        index = 0
+
+
+def decode_json(infile, buffer, index):
+    '''
+    Decode the JSON value starting at buffer[index], reading more of the file
+    until it is complete.
+
+    Returns: (value, buffer, index) tuple, index being just past the value
+    '''
+    text, buffer, index = scan_json(infile, buffer, index)
+    return json.loads(text), buffer, index
+
+
+def scan_json(infile, buffer, index, keep=True):
+    '''
+    Find the end of the JSON value starting at buffer[index], reading more of
+    the file as needed. Only string and bracket nesting is tracked, jumping
+    between the characters that change it, so this is linear in the size of
+    the value and doesn't build anything.
+
+    Arguments:
+        infile: open JSON file that buffer was read from
+        buffer: the text read so far, with buffer[index] starting the value
+        index: see buffer
+        keep: whether to hand back the text of the value
+
+    Returns: (text or None, buffer, index) tuple, buffer being what has been
+        read by now and index being just past the value in it
+    '''
+    pieces = []
+    start = index
+    scalar = buffer[index] not in '[{"'
+    depth = 0
+    in_string = False
+    end = None
+    while True:
+        if scalar:
+            match = SCALAR_END.search(buffer, index)
+            if match is not None:
+                end = match.start()
+            index = len(buffer)
+        while end is None and index < len(buffer):
+            if in_string:
+                match = STRING_END.search(buffer, index)
+                if match is None:
+                    index = len(buffer)
+                elif match.group() == "\\":
+                    # Skip the escaped character, which might be in the next
+                    # chunk
+                    index = match.end() + 1
+                else:
+                    in_string = False
+                    index = match.end()
+                    if depth == 0:
+                        end = index
+            else:
+                match = STRUCTURE.search(buffer, index)
+                if match is None:
+                    index = len(buffer)
+                    continue
+                index = match.end()
+                if match.group() == '"':
+                    in_string = True
+                elif match.group() in "[{":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        end = index
+        if end is not None:
+            break
+
+        # Hold on to the pieces and join them once at the end, rather than
+        # adding every chunk onto one ever longer buffer
+        if keep:
+            pieces.append(buffer[start:])
+        chunk = infile.read(CHUNK_SIZE)
+        if not chunk:
+            if scalar:
+                buffer, index, end = "", 0, 0
+                start = 0
+                break
+            raise ValueError(f"Unexpected end of {infile.name}")
+        # An escape at the very end of the last chunk skips into this one
+        index = index - len(buffer)
+        buffer = chunk
+        start = 0
+
+    text = None
+    if keep:
+        pieces.append(buffer[start:end])
+        text = "".join(pieces)
+    return text, buffer, end
+
+
+def file_hash(path):
+    '''Content hash of a file, read in chunks so big exports are fine.'''
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compile_store(input_file, file_type, store_dir):
+    '''
+    Parse a polygon export once into a store directory, so it can be rasterized
+    again (with new class priorities, SIZE, etc.) without touching the JSON.
+    The store holds flat columns as .npy files that get memory mapped:
+        vertices: (V, 2) int32 (x, y) points as fixed point numbers with
+            SUBPIXEL fractional bits, exactly what gets rasterized. float32
+            can't hold 2448.xxxx to 1/16 of a pixel.
+        offsets: (P+1,) int64, polygon i is vertices[offsets[i]:offsets[i+1]]
+        classes: (P,) int16 class of each polygon
+        images: (P,) int32 sorted index of the image each polygon belongs to
+    Plus a meta.json with the image names and what the store was built from.
+    '''
+    if file_type == "coco-json":
+        by_name = {}
+        for name, _, polygons in coco_jobs(input_file,
+                                           None,
+                                           coco_names(input_file)):
+            # Images with the same name overwrite each other, the last by id
+            # wins like it does when converting straight from the JSON
+            by_name[name] = polygons
+        grouped = list(by_name.items())
+    elif file_type == "diffgram-json":
+        grouped = [(None, diffgram_polygons(input_file))]
+    elif file_type == "H-json":
+        grouped = [(None, h_json_polygons(input_file))]
+    elif file_type == "F-json":
+        grouped = [(None, f_json_polygons(input_file))]
+    else:
+        raise NotImplementedError()
+
+    vertices = []
+    offsets = [0]
+    classes = []
+    images = []
+    for index, (_, polygons) in enumerate(grouped):
+        for classid, points in polygons:
+            fixed = (numpy.asarray(points) * 2**SUBPIXEL).astype(numpy.int32)
+            vertices.append(fixed)
+            offsets.append(offsets[-1] + len(fixed))
+            classes.append(classid)
+            images.append(index)
+
+    store_dir.mkdir(parents=True, exist_ok=True)
+    columns = {
+        "vertices": numpy.concatenate(vertices or [numpy.zeros((0, 2))]),
+        "offsets": numpy.array(offsets),
+        "classes": numpy.array(classes),
+        "images": numpy.array(images),
+    }
+    for key, dtype in (("vertices", numpy.int32),
+                       ("offsets", numpy.int64),
+                       ("classes", numpy.int16),
+                       ("images", numpy.int32)):
+        numpy.save(store_dir.joinpath(f"{key}.npy"),
+                   columns[key].astype(dtype))
+    # Written last, so a store that was cut off halfway isn't current
+    meta = {
+        "names": [name for name, _ in grouped],
+        # Diffgram debug images mark the polygon points
+        "vis_points": file_type == "diffgram-json",
+        "source": store_source(input_file, file_type),
+    }
+    json.dump(meta, store_dir.joinpath("meta.json").open("w"), indent=1)
+    print(f"Compiled {len(classes)} polygons into {store_dir}")
+
+
+def store_source(input_file, file_type):
+    '''Everything that decides what goes into a compiled polygon store.'''
+    source = {
+        "hash": file_hash(input_file),
+        "file_type": file_type,
+        "version": STORE_VERSION,
+        "subpixel": SUBPIXEL,
+        "classes": CLASSES,
+        "unmerged": UNMERGED.get(input_file.name),
+        "split": [SPLIT_JUMP, SPLIT_CLOSURE],
+    }
+    # Round trip so tuples compare equal to what was read back from JSON
+    return json.loads(json.dumps(source))
+
+
+def store_is_current(store_dir, input_file, file_type):
+    '''Check whether a store was compiled from this exact input.'''
+    meta_path = store_dir.joinpath("meta.json")
+    if not meta_path.is_file():
+        return False
+    meta = json.load(meta_path.open("r"))
+    return meta["source"] == store_source(input_file, file_type)
+
+
+def load_store(store_dir):
+    '''Memory map the columns of a polygon store, see compile_store.'''
+    store = {
+        key: numpy.load(store_dir.joinpath(f"{key}.npy"), mmap_mode="r")
+        for key in ("vertices", "offsets", "classes", "images")
+    }
+    store["meta"] = json.load(store_dir.joinpath("meta.json").open("r"))
+    return store
+
+
+def store_label(image, store_dir, workers=None):
+    '''
+    Rasterize a compiled polygon store. Images are drawn in a process pool and
+    streamed out as (name, image) pairs.
+
+    Returns: two-element tuple
+        [0]: iterator of (name, image) pairs
+        [1]: debug image with the points marked for single image stores that
+            were compiled from Diffgram, otherwise None
+    '''
+    store = load_store(store_dir)
+    names = store["meta"]["names"]
+    vis_image = None
+    if store["meta"]["vis_points"] and len(names) == 1:
+        vis_image = draw_store_image(store,
+                                     0,
+                                     image.shape,
+                                     add_points=VIS_POINTS)
+    jobs = [(store_dir, index, image.shape) for index in range(len(names))]
+    images = pool_map(store_job, jobs, 1 if len(names) == 1 else workers)
+    return images, vis_image
+
+
+def store_job(job):
+    '''
+    Draw one image of a polygon store. Takes and returns a single tuple so it
+    can be mapped over by a process pool.
+
+    Arguments:
+        job: (store_dir, index, shape) tuple
+
+    Returns: (name, canvas) tuple
+    '''
+    store_dir, index, shape = job
+    store = load_store(store_dir)
+    return store["meta"]["names"][index], draw_store_image(store, index, shape)
+
+
+def draw_store_image(store, index, shape, add_points=None):
+    '''Draw all polygons of one image in a loaded store onto a new canvas.'''
+    canvas = new_canvas(shape)
+    offsets = store["offsets"]
+    # Slicing the memory mapped columns doesn't copy anything
+    first, last = numpy.searchsorted(store["images"], [index, index + 1])
+    for polygon in range(first, last):
+        draw_fixed_polygon(canvas,
+                           int(store["classes"][polygon]),
+                           store["vertices"][offsets[polygon]:offsets[polygon+1]],
+                           add_points)
+    return canvas
+
+
+def coco_label(image, json_file, workers=None):
+    '''
+    Process files as they come out of CVAT using the COCO format. Annotations
+    are streamed out of the file and each image is rasterized in a process pool
+    as soon as all of its annotations have been read. Images are yielded as
+    (name, image) pairs, so they can be saved without holding all of them.
+    '''
+    names = coco_names(json_file)
+    yield from pool_map(rasterize_job,
+                        coco_jobs(json_file, image.shape, names),
+                        1 if len(names) == 1 else workers)
 
-        # Save
-        cv2.imwrite(str(output_path), image)
-        print(f"Saved to {str(output_path)}")
 
-        # Then make a debug version
-        if vis_image is None or name is not None:
-            vis_image = image
-        vis_image[0, 0] = len(CLASSES)
-        pyplot.imsave(str(output_path).replace(".png", "_vis.png"), vis_image)
+def coco_names(json_file):
+    '''Map image id to output image name for a COCO file.'''
+    names = {}
+    for image_meta in iter_json_array(json_file, "images"):
+        names[image_meta["id"]] = image_meta["file_name"].split("/")[-1]
+    # This is a bit messy, but in the case where the label file only has
+    # one image, don't use the image_name to distinguish them.
+    if len(names) == 1:
+        names = {image_id: None for image_id in names}
+    return names
 
 
-def coco_label(image, json_file):
-    '''Process files as they come out of CVAT using the COCO format.'''
-    labeldata = json.load(json_file.open("r"))
-    annotations = labeldata["annotations"]
-    output = {}
+def coco_jobs(json_file, shape, names):
+    '''
+    Yield a rasterize_job tuple for every image in a COCO file, in image id
+    order. CVAT writes annotations grouped by image in id order, which a first
+    pass over the file checks, and then each job goes out as soon as the next
+    image's annotations start. Otherwise all annotations are grouped in memory
+    first.
+    '''
+    if not coco_in_order(json_file, names):
+        print(f"Annotations in {json_file} aren't in image order,"
+              f" regrouping all of them in memory")
+        yield from grouped_coco_jobs(json_file, shape, names)
+        return
+
     # So there's this annoying happened where the labels from two images got
     # mashed together and written over each other. This "seen" set is used to
     # check that we aren't adding sets of points twice. I don't know if this
-    # issue will ever arise again.
+    # issue will ever arise again. It spans images, so it has to be resolved
+    # here in order before anything is handed out to the workers.
     seen = set()
-    for image_meta in sorted(labeldata["images"], key=lambda x: x["id"]):
-        copied = numpy.ones(image.shape, dtype=image.dtype) * -1
-        image_id = image_meta["id"]
-        image_name = image_meta["file_name"].split("/")[-1]
-        # This is a bit messy, but in the case where the label file only has
-        # one image, don't use the image_name to distinguish them.
-        if len(labeldata["images"]) == 1:
-            image_name = None
-        for annotation in annotations:
-            if annotation["image_id"] != image_id:
-                continue
+    # Images without any annotations still get an (empty) label image
+    remaining = deque(sorted(names))
+    current = None
+    polygons = []
+    for annotation in iter_json_array(json_file, "annotations"):
+        image_id = annotation["image_id"]
+        if image_id not in names:
+            continue
+        if image_id != current:
+            if current is not None:
+                yield names[current], shape, polygons
+            while remaining[0] != image_id:
+                yield names[remaining.popleft()], shape, []
+            remaining.popleft()
+            current = image_id
+            polygons = []
+        polygon = coco_polygon(annotation, seen)
+        if polygon is not None:
+            polygons.append(polygon)
+    if current is not None:
+        yield names[current], shape, polygons
+    for image_id in remaining:
+        yield names[image_id], shape, []
 
-            segmentation = numpy.array(annotation["segmentation"]).squeeze()
-            # Clip this to the first 300 elements because there was a case
-            # where the points stopped matching at this point, and 300 points
-            # should be plenty enough to determine identity.
-            seen_key = str(segmentation[:300])
-            if seen_key in seen:
-                continue
-            seen.add(seen_key)
 
-            classid = annotation["category_id"]
-            copied = draw_polygon(
-                copied,
-                classid,
-                # (x, y) points come out interleaved as [x1, y1, x2, y2, ...]
-                # and need to be reshaped into (N, 2)
-                segmentation.reshape((-1, 2)),
-            )
-        output[image_name] = copied
-    return output
+def coco_in_order(json_file, names):
+    '''Check whether the annotations of a COCO file are sorted by image id.'''
+    previous = None
+    for annotation in iter_json_array(json_file, "annotations"):
+        image_id = annotation["image_id"]
+        if image_id not in names:
+            continue
+        if previous is not None and image_id < previous:
+            return False
+        previous = image_id
+    return True
+
+
+def grouped_coco_jobs(json_file, shape, names):
+    '''
+    Same as coco_jobs, but groups every annotation by image first, so it works
+    on any ordering at the cost of holding all of them.
+    '''
+    by_image = {}
+    for annotation in iter_json_array(json_file, "annotations"):
+        by_image.setdefault(annotation["image_id"], []).append(annotation)
+    seen = set()
+    for image_id in sorted(names):
+        polygons = [coco_polygon(annotation, seen)
+                    for annotation in by_image.get(image_id, [])]
+        yield (names[image_id],
+               shape,
+               [polygon for polygon in polygons if polygon is not None])
+
+
+def coco_polygon(annotation, seen):
+    '''
+    Turn a COCO annotation into a (classid, points) pair, or None if the same
+    points were already seen (and recorded in the given set).
+    '''
+    segmentation = numpy.array(annotation["segmentation"]).squeeze()
+    # Clip this to the first 300 elements because there was a case where the
+    # points stopped matching at this point, and 300 points should be plenty
+    # enough to determine identity.
+    seen_key = str(segmentation[:300])
+    if seen_key in seen:
+        return None
+    seen.add(seen_key)
+    return (
+        annotation["category_id"],
+        # (x, y) points come out interleaved as [x1, y1, x2, y2, ...] and need
+        # to be reshaped into (N, 2)
+        segmentation.reshape((-1, 2)),
+    )
+
+
+def pool_map(function, jobs, workers=None):
+    '''
+    Lazily map function over jobs in a process pool of the given size (all
+    cores if None), in order. A single worker skips the pool entirely.
+    '''
+    if workers == 1:
+        yield from map(function, jobs)
+    else:
+        with Pool(workers) as pool:
+            yield from bounded_imap(pool,
+                                    function,
+                                    jobs,
+                                    2 * (workers or os.cpu_count()))
+
+
+def rasterize_job(job):
+    '''
+    Draw a list of (classid, points) polygons onto a fresh canvas. Takes and
+    returns a single tuple so it can be mapped over by a process pool.
+
+    Arguments:
+        job: (name, shape, polygons) tuple
+
+    Returns: (name, canvas) tuple
+    '''
+    name, shape, polygons = job
+    canvas = new_canvas(shape)
+    for classid, points in polygons:
+        draw_polygon(canvas, classid, points)
+    return name, canvas
 
 
+# Merged diffgram instances are split where consecutive points jump more than
+# SPLIT_JUMP pixels, if the piece before the jump closes up to within
+# SPLIT_CLOSURE pixels. See find_cuts.
+SPLIT_JUMP = 40
+SPLIT_CLOSURE = SPLIT_JUMP
 # This is horrible, but for the first diffgram export I had to manually go
-# through and separate merged instances :'(
+# through and separate merged instances :'( Now these are just a cache of
+# accepted find_cuts output, or hand fixes where it gets things wrong.
 UNMERGED = {
     "3400_diffgram_annotations__source_task_98991_datetime_2022-06-02T23-53-19.191400.json": [0, 92, 275, 341, 520, 559, 746, 975, 1114, 1228, 1289, 1335, 1467, 1507, 1547, 1572, 1594, 1619, 1631, 1683, 1758, 1799, 1879, 2009, 2042, 2140, 2249, 2335, 2354, 2370, 2411, 2439, 2460, 2534, 2594, 2665, 2693, 2727, 2759, 2885, 2930, 2963, 2981, 3019, 3091, 3105, 3113, 3159, 3195, 3276, 3328, 3407, 3439, 3446, 3513, 3579, 3605, 3635, 3760, 3820, 3825, 3866, 3948, 3989, 4123, 4135, 4202, 4239, 4263, 4323, 4390, 4439, 4477, 4491, 4499, 4650, 4720, 4813, 4843, 4854, 4901, 4951, 5141, 5149, 5193, 5243, 5257, 5264, 5288, 5303, 5345, 5391, 5533, 5561, 5699, 5749, 5815, 5831, 5847, 5867, 5906, 5971, 5997, 6029, 6046, 6093, 6169, 6183, 6228, 6460, 6508, 6545, 6630, 6646, 6669, 6737, 6786, 6803, 6853, 6866, 6912, 6936, 6997, 7050, 7167, 7265, 7319, 7389, 7513, 7533, 7543, 7583, 7615, 7718, 7781]
 }
@@ -119,20 +822,20 @@ def diffgram_label(image, json_file):
     '''Process the json files as they come out of Diffgram.'''
     # Extra debug image
     vis_image = image.copy()
-    vis_value = max(CLASSES.values()) + 1
-
-    labeldata = json.load(json_file.open("r"))
-    label_map = labeldata["label_map"]
-    # Identify which variable has the "instance_list" attribute. It appears to
-    # be a random number in my first example so I'm not sure how stable that is
-    instances = None
-    for dictionary in labeldata.values():
-        if "instance_list" in dictionary:
-            # Make sure this only happens once
-            assert instances is None
-            instances = dictionary["instance_list"]
-    # Then loop through each polygon
-    for i, instance in enumerate(instances):
+    for classid, points in diffgram_polygons(json_file):
+        image = draw_polygon(image, classid, points)
+        vis_image = draw_polygon(vis_image, classid, points, add_points=VIS_POINTS)
+    return {None: image}, vis_image
+
+
+def diffgram_polygons(json_file):
+    '''Yield (classid, points) polygons out of a Diffgram json file.'''
+    label_map = read_json_value(json_file, "label_map")
+    # The "instance_list" attribute lives under what appears to be a random
+    # number in my first example, so look for it in every top level object.
+    # Then loop through each polygon as it's read.
+    for i, instance in enumerate(iter_json_array(json_file, "instance_list",
+                                                 nested=True)):
         assert instance["type"] == "polygon", \
                f"Shape type {instance['type']} was not a polygon"
         classid = CLASSES[label_map[str(instance["label_file_id"])].lower()]
@@ -140,115 +843,222 @@ def diffgram_label(image, json_file):
         # Oh god so hacky. In my first diffgram image there appears to be a
         # big problem where I merged instances to make it exportable, and that
         # really screws up the rendering. I can't see how to detect that case,
-        # so for now I'll detect it with number of points. Then I guess I'll
-        # split up instances based on nearness of points? Ugh.
+        # so for now I'll detect it with number of points. Then the instance
+        # is split up based on jumps between consecutive points, unless there
+        # are already accepted cuts for this file in UNMERGED.
         if len(points) < 7500:
-            image = draw_polygon(image, classid, points)
-            vis_image = draw_polygon(vis_image, classid, points, add_points=vis_value)
+            yield classid, points
         else:
             if json_file.name in UNMERGED:
-                for subset in get_point_subsets(points, UNMERGED[json_file.name]):
-                    image = draw_polygon(image, classid, subset)
-                    vis_image = draw_polygon(vis_image, classid, subset, add_points=vis_value)
+                cuts = UNMERGED[json_file.name]
             else:
-                discover_subsets(points)
-    return {None: image}, vis_image
+                cuts = find_cuts(points)
+                print(f"Split merged instance {i} of {json_file.name} into"
+                      f" {len(cuts) - 1} polygons, check the _vis image and"
+                      f" add these cuts to UNMERGED to keep them: {cuts}")
+            for subset in get_point_subsets(points, cuts):
+                yield classid, subset
 
 
 def h_json_label(image, json_file):
     '''
     Process the json files as they come out of whatever H shared with me first.
     '''
-    labeldata = json.load(json_file.open("r"))
-    shapes = labeldata["shapes"]
-    for shape in shapes:
-        assert shape["shape_type"] == "polygon"
-        classid = CLASSES[shape["label"].lower()]
-        image = draw_polygon(image, classid, shape["points"])
+    for classid, points in h_json_polygons(json_file):
+        image = draw_polygon(image, classid, points)
     return {None: image}
 
 
+def h_json_polygons(json_file):
+    '''Yield (classid, points) polygons out of one of H's json files.'''
+    for shape in iter_json_array(json_file, "shapes"):
+        assert shape["shape_type"] == "polygon"
+        yield CLASSES[shape["label"].lower()], shape["points"]
+
+
 def f_json_label(image, json_file):
     '''
     Process the json files as they come out of whatever F shared with me when
     CVAT stopped working.
     '''
-    labeldata = json.load(json_file.open("r"))
-    instances = labeldata["instances"]
-    for instance in instances:
+    for classid, points in f_json_polygons(json_file):
+        image = draw_polygon(image, classid, points)
+    return {None: image}
+
+
+def f_json_polygons(json_file):
+    '''Yield (classid, points) polygons out of one of F's json files.'''
+    for instance in iter_json_array(json_file, "instances"):
         assert instance["type"] == "polygon"
-        classid = CLASSES[instance["className"].lower()]
         points = numpy.array(instance["points"]).squeeze()
-        image = draw_polygon(
-            image,
-            classid,
-            # (x, y) points come out interleaved as [x1, y1, x2, y2, ...]
-            # and need to be reshaped into (N, 2)
-            points.reshape((-1, 2)),
-        )
-    return {None: image}
+        # (x, y) points come out interleaved as [x1, y1, x2, y2, ...] and need
+        # to be reshaped into (N, 2)
+        yield CLASSES[instance["className"].lower()], points.reshape((-1, 2))
 
 
 def label_by_color(image, ann_img_path, colors_file):
+    '''
+    Process images where each class was painted in a known color. Every pixel
+    is packed into a 24-bit RGB key and looked up in one pass. Pixels with a
+    color that isn't in colors_file are left at -1 and reported.
+    '''
+
+    lut = color_lut(colors_file)
+
+    # Annotated image comes in as BGR, pack it as 0xRRGGBB
+    ann_img = cv2.imread(str(ann_img_path))
+    keys = ann_img[..., 2].astype(numpy.uint32) << 16
+    keys |= ann_img[..., 1].astype(numpy.uint32) << 8
+    keys |= ann_img[..., 0]
+    labels = lut[keys]
+
+    known = labels >= 0
+    image[known] = labels[known]
+
+    if not known.all():
+        unknown, counts = numpy.unique(keys[~known], return_counts=True)
+        order = numpy.argsort(counts)[::-1][:5]
+        common = ", ".join(
+            f"({key >> 16}, {(key >> 8) & 0xFF}, {key & 0xFF})x{count}"
+            for key, count in zip(unknown[order], counts[order])
+        )
+        print(f"WARNING: {ann_img_path} has {numpy.count_nonzero(~known)}"
+              f" pixels in {len(unknown)} colors not in {colors_file},"
+              f" most common {common}")
+
+    return {None: image}
+
 
-    # Read in the colors
-    colors = {}
+@lru_cache(maxsize=None)
+def color_lut(colors_file):
+    '''
+    Build a 2**24 element lookup table from a packed 0xRRGGBB color to class,
+    with -1 for unknown colors. Cached since batch runs reuse the same file.
+    '''
+    lut = numpy.full(2**24, -1, dtype=numpy.int8)
     with open(colors_file, "r") as infile:
         for line in infile.readlines():
             # This looks complicated, but it just takes
             # 147 203 131 Leaf
             # and turns it into
-            # {(147, 203, 131): "leaf"}
-            colors[tuple(map(int, line.split()[:3]))] = line.split()[-1].lower()
+            # lut[0x93CB83] = CLASSES["leaf"]
+            red, green, blue = map(int, line.split()[:3])
+            lut[(red << 16) | (green << 8) | blue] = \
+                CLASSES[line.split()[-1].lower()]
+    return lut
 
-    # And the annotated image
-    ann_img = cv2.cvtColor(cv2.imread(str(ann_img_path)), cv2.COLOR_BGR2RGB)
 
-    # Figure out which parts of the annotated image go with which color/class
-    for color, classname in colors.items():
-        mask = (ann_img == color).all(axis=2)
-        image[mask] = CLASSES[classname]
+# Overlap priority for pixels that were already labeled when a new polygon
+# lands on them, indexed by the int8 canvas value viewed as uint8. Lower rank
+# wins. This keeps the lowest numbered class, so vines (class 1) win if there
+# is overlap, except that leaves (class 4) are slotted in ahead of trunk and
+# post (classes 2 and 3). This is not 100% right but it's the best choice.
+RANK = numpy.arange(256) * 2
+RANK[CLASSES["leaf"]] = 2 * CLASSES["vine"] + 1
+# Add a few decimal points of sub-pixel accuracy, possible with fillPoly
+SUBPIXEL = 4
 
-    return {None: image}
+
+def new_canvas(shape=SIZE):
+    '''Compact label canvas, -1 is unlabeled and everything else a class.'''
+    return numpy.full(shape, -1, dtype=numpy.int8)
 
 
 def draw_polygon(image, classid, points, add_points=None):
-    points = numpy.array(points)
-    altered = image.copy()
-    # Add a few decimal points of sub-pixel accuracy, possible with fillPoly
-    SUBPIXEL = 4
-    subpixel_points = (points * 2**SUBPIXEL).astype(int)
-    cv2.fillPoly(img=altered, pts=[subpixel_points], color=classid, shift=SUBPIXEL)
+    '''
+    Rasterize a polygon into an int8 label canvas (see new_canvas), in place.
+    Only the polygon's bounding box is touched, and overlaps with previously
+    labeled pixels are resolved with RANK.
 
-    if add_points is not None:
+    Arguments:
+        image: (H, W) int8 canvas, modified in place and returned
+        classid: integer class value to fill the polygon with
+        points: (N, 2) array-like of (x, y) float points
+        add_points: if not None, also mark each polygon point and the last
+            point (as a small square) with this value, for debugging
+
+    Returns: the same canvas, for convenience
+    '''
+    points = numpy.asarray(points)
+    return draw_fixed_polygon(
+        image,
+        classid,
+        (points * 2**SUBPIXEL).astype(int),
+        add_points,
         # int(x + 0.5) is a trick to round numbers to nearest int
-        int_points = (points + 0.5).astype(int)
-        altered[int_points.T[1], int_points.T[0]] = add_points
+        None if add_points is None else (points + 0.5).astype(int),
+    )
+
+
+def draw_fixed_polygon(image, classid, subpixel_points, add_points=None,
+                       int_points=None):
+    '''
+    The guts of draw_polygon, for points that are already fixed point numbers
+    with SUBPIXEL fractional bits (like the ones in a polygon store). If
+    add_points is given without int_points, the marked pixels are rounded
+    from the fixed point numbers, which is exact for points inside the image.
+    '''
+    height, width = image.shape
+
+    # Pixel bounding box of the polygon with a one pixel margin for rounding,
+    # clipped to the image
+    low = (subpixel_points.min(axis=0) >> SUBPIXEL) - 1
+    high = (subpixel_points.max(axis=0) >> SUBPIXEL) + 2
+    x0, x1 = numpy.clip((low[0], high[0]), 0, width)
+    y0, y1 = numpy.clip((low[1], high[1]), 0, height)
+
+    marked = None
+    if add_points is not None:
+        if int_points is None:
+            int_points = (subpixel_points + 2**(SUBPIXEL - 1)) >> SUBPIXEL
+        # Resolve these through range/arange so they wrap around exactly like
+        # direct indexing into the image would
+        rows = numpy.arange(height)[int_points.T[1]]
+        cols = numpy.arange(width)[int_points.T[0]]
         last = int_points[-1]
-        altered[last[1]-2:last[1]+2, last[0]-2:last[0]+2] = add_points
-
-    # This is a little complicated, but basically we want to keep the lowest
-    # numbered classes that are not the background. Basically we want to
-    # prioritize vines if there is overlap (class 1). This is not 100% right
-    # but it's the best choice.
-    already_set = image > 0
-    unequal = image != altered
-    mask = numpy.logical_and(already_set, unequal)
-    # As a hack, let's prioritize leaves (class 4) over trunk and post
-    # (classes 2 and 3)
-    altered[altered == 4] = 1.5
-    image[image == 4] = 1.5
-    altered[mask] = numpy.min((altered[mask], image[mask]), axis=0)
-    altered[altered == 1.5] = 4
-    image[image == 1.5] = 4
-
-    # Then update our understanding
-    return altered
+        box_rows = range(height)[last[1]-2:last[1]+2]
+        box_cols = range(width)[last[0]-2:last[0]+2]
+        marked = (rows, cols, box_rows, box_cols)
+        # Grow the bounding box to cover the marked points
+        x0 = min([x0, cols.min()] + list(box_cols[:1]))
+        x1 = max([x1, cols.max() + 1] + [c + 1 for c in box_cols[-1:]])
+        y0 = min([y0, rows.min()] + list(box_rows[:1]))
+        y1 = max([y1, rows.max() + 1] + [r + 1 for r in box_rows[-1:]])
+
+    if x0 >= x1 or y0 >= y1:
+        return image
+
+    # Translating by whole pixels in subpixel units rasterizes exactly the
+    # same pixels as drawing on the full image would
+    painted = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.uint8)
+    offset = numpy.array([x0, y0]) << SUBPIXEL
+    cv2.fillPoly(img=painted, pts=[subpixel_points - offset], color=1, shift=SUBPIXEL)
+    values = numpy.full(painted.shape, classid, dtype=image.dtype)
+
+    if marked is not None:
+        rows, cols, box_rows, box_cols = marked
+        painted[rows - y0, cols - x0] = 1
+        values[rows - y0, cols - x0] = add_points
+        if len(box_rows) and len(box_cols):
+            box = (slice(box_rows[0] - y0, box_rows[-1] - y0 + 1),
+                   slice(box_cols[0] - x0, box_cols[-1] - x0 + 1))
+            painted[box] = 1
+            values[box] = add_points
+
+    # Unlabeled pixels (background or -1) always take the new value, labeled
+    # ones only if the new value outranks them
+    window = image[y0:y1, x0:x1]
+    claim = painted.astype(bool)
+    claim &= (window <= 0) | (RANK[values.view(numpy.uint8)] < RANK[window.view(numpy.uint8)])
+    window[claim] = values[claim]
+
+    return image
 
 
 # Build up a list of files and the pixel values that we want to floodfill.
 # Let's assume for now that we will only do this for vines. Values extracted
-# using pinta.
+# using pinta. Most of these are now found by fill_enclosed_gaps, so this is
+# only an override for holes the automatic rules miss (e.g. touching a post).
 KNOWN_FILL = {
     # H.S. first set of 10
     "2021-12-01-12-36-30_cam1_6.png": [(926, 596), (175, 508), (1555, 912), (1080, 1130), (993, 1236), (880, 1258), (836, 1285), (986, 963), (1128, 1014), (1617, 1920), (1363, 450), (1780, 285)],
@@ -310,15 +1120,73 @@ KNOWN_FILL = {
 }
 
 
+# Scratch buffers for fill_enclosed_gaps keyed by image shape, so converting
+# many images doesn't allocate fresh ones every time
+GAP_BUFFERS = {}
+
+
+def fill_enclosed_gaps(image, max_area=MAX_HOLE_AREA):
+    '''
+    Find background holes left by self-intersecting vine polygons and fill them
+    in as vine, in place. A hole is a 4-connected background (0) component
+    that is at most max_area pixels, doesn't touch the image border, and only
+    borders vine pixels. All components are judged in one labeling pass.
+
+    Arguments:
+        image: (H, W) uint8 label image
+        max_area: largest hole to fill, 0 turns this off
+
+    Returns: the same image, for convenience
+    '''
+    if max_area <= 0:
+        return image
+
+    if image.shape not in GAP_BUFFERS:
+        GAP_BUFFERS[image.shape] = (numpy.empty(image.shape, dtype=bool),
+                                    numpy.empty(image.shape, dtype=numpy.int32))
+    background, labels = GAP_BUFFERS[image.shape]
+    numpy.equal(image, 0, out=background)
+    number, labels, stats, _ = cv2.connectedComponentsWithStats(
+        background.view(numpy.uint8),
+        labels=labels,
+        connectivity=4,
+        ltype=cv2.CV_32S,
+    )
+
+    height, width = image.shape
+    left, top, w, h, area = stats.T
+    fill = (area <= max_area) & \
+           (left > 0) & (top > 0) & (left + w < width) & (top + h < height)
+    # The non-background pixels are all lumped in as label 0
+    fill[0] = False
+    if not fill.any():
+        return image
+
+    # Any background pixel with a 4-neighbor that is neither background (the
+    # same component) nor vine rules its whole component out
+    vine = CLASSES["vine"]
+    for here, there in ((labels[:, :-1], image[:, 1:]),
+                        (labels[:, 1:], image[:, :-1]),
+                        (labels[:-1], image[1:]),
+                        (labels[1:], image[:-1])):
+        touching = (here > 0) & (there != 0) & (there != vine)
+        fill[here[touching]] = False
+
+    image[fill[labels]] = vine
+    return image
+
+
 def fill_known_gaps(output_file, image):
     if output_file.name in KNOWN_FILL:
+        # One mask is enough, flood fills only mark pixels they just filled
+        height, width = image.shape
+        mask = numpy.zeros((height+2, width+2), numpy.uint8)
         for pixel in KNOWN_FILL[output_file.name]:
+            # Probably already found by fill_enclosed_gaps
+            if image[pixel[1], pixel[0]] == CLASSES["vine"]:
+                continue
             assert image[pixel[1], pixel[0]] == 0, f"Pixel {pixel} != 0..."
-            height, width = image.shape
-            cv2.floodFill(image,
-                          numpy.zeros((height+2, width+2), numpy.uint8),
-                          pixel,
-                          CLASSES["vine"])
+            cv2.floodFill(image, mask, pixel, CLASSES["vine"])
     return image
 
 
@@ -331,61 +1199,44 @@ def get_point_subsets(points, cuts):
         yield points[cuts[i]:cuts[i+1]]
 
 
-# What a goddamn mess
-def discover_subsets(points):
+def find_cuts(points, jump=SPLIT_JUMP, closure=SPLIT_CLOSURE):
     '''
-    Go through an interactive process to walk through the image and figure out
-    by hand which subsets were taken together. Hopefully I'll never have to use
-    this again.
+    Automatically find where a merged instance should be cut back into its
+    original polygons, in the same format as the UNMERGED cut lists. Cuts go
+    wherever consecutive points are more than jump pixels apart. Optionally a
+    cut is only accepted once the polygon it closes off ends within closure
+    pixels of where it started, otherwise the jump is taken to be a long edge
+    inside one polygon.
+
+    Arguments:
+        points: (N, 2) numpy array of the merged instance's points
+        jump: distance between consecutive points that counts as a new polygon
+        closure: max start to end distance of an accepted polygon, None or 0
+            to accept every jump
 
-    Controls:
-        p: toggle the real image on and off
-        q, w, e, r, t, y: step the label points by -15, -5, -1, 1, 5, 15 steps
-        x: exit
-        a: print the current counter
+    Returns: list of cut indices, starting at 0 and ending at N
     '''
-    cv2.namedWindow("discover")
-    sizeNN3 = SIZE + (3,)
-    image = numpy.zeros(sizeNN3)
-    real = None
-    cutpoints = [0]
-    counter = max(5, cutpoints[-1])
-    while True:
-        if real is None:
-            cv2.imshow("discover", image.astype(numpy.uint8))
-        else:
-            cv2.imshow("discover", (0.5*image + 0.5*real).astype(numpy.uint8))
-        key = chr(cv2.waitKey(0))
-        if key == "p":
-            if real is None:
-                real = cv2.imread("/home/eric/Downloads/2021-12-01-16-52-30_cam1_1.png")
-            else:
-                real = None
-            continue
-        if key == "a":   print(counter)
-        elif key == "q": counter -= 15
-        elif key == "w": counter -= 5
-        elif key == "e": counter -= 1
-        elif key == "r": counter += 1
-        elif key == "t": counter += 5
-        elif key == "y": counter += 15
-        elif key == "s":
-            cutpoints.append(counter)
-            print(f"Cutpoints: {cutpoints}")
-        elif key == "x": break
-        else:            continue
-        image = numpy.zeros(sizeNN3)
-        for i in range(max(0, len(cutpoints) - 16), len(cutpoints) - 1):
-            image = draw_polygon(image,
-                                 (50, 255, 50),
-                                 points[cutpoints[i]:cutpoints[i+1]],
-                                 (255, 255, 255))
-        if cutpoints[-1] < counter - 1:
-            image = draw_polygon(image,
-                                 (50, 50, 255),
-                                 points[cutpoints[-1]:counter],
-                                 (255, 255, 255))
-    cv2.destroyAllWindows()
+    steps = numpy.linalg.norm(numpy.diff(points, axis=0), axis=1)
+    candidates = numpy.flatnonzero(steps > jump) + 1
+    if not closure:
+        return [0] + candidates.tolist() + [len(points)]
+
+    def closes(start, end):
+        return end - start >= 3 and \
+            numpy.linalg.norm(points[end - 1] - points[start]) <= closure
+
+    cuts = [0]
+    previous = 0
+    for candidate in candidates:
+        if closes(cuts[-1], candidate):
+            cuts.append(int(candidate))
+        # Recover from a bad cut (or a missed one) as soon as the piece since
+        # the last jump closes on its own
+        elif closes(previous, candidate):
+            cuts.extend((int(previous), int(candidate)))
+        previous = candidate
+    cuts.append(len(points))
+    return cuts
 
 
 def parse_args():
@@ -393,32 +1244,79 @@ def parse_args():
         description=__doc__,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
+    parser.add_argument(
+        "-b", "--batch",
+        help="Directory or glob (quote it) of exports to convert in one go,"
+             " instead of --input-file. Then --output-path is a directory, a"
+             " manifest is kept there, and unchanged inputs are skipped on"
+             " re-runs. Without --file-type the type of each input is guessed.",
+        default=None,
+    )
     parser.add_argument(
         "-c", "--colors-file",
-        help="F's images come with an associated color file.",
+        help="F's images come with an associated color file. A whole folder"
+             " of color-coded images can be converted with --batch.",
         type=Path,
     )
     parser.add_argument(
         "-i", "--input-file",
         help="Polygonally labelled JSON file or color labeled images, depending"
              " on the file type.",
-        required=True,
         type=Path,
     )
+    parser.add_argument(
+        "-m", "--max-hole-area",
+        help="Background holes up to this many pixels that are surrounded by"
+             " vine are filled in as vine. 0 turns this off, leaving only the"
+             " hand-made KNOWN_FILL table.",
+        type=int,
+        default=MAX_HOLE_AREA,
+    )
     parser.add_argument(
         "-o", "--output-path",
         help="Where the annotated image should be written.",
         required=True,
         type=Path,
     )
+    parser.add_argument(
+        "-s", "--store",
+        help="Compile a polygon export into this directory (or reuse it if it"
+             " is up to date) and rasterize from there. Later runs can use the"
+             " directory as --input-file with --file-type polygon-store and"
+             " skip the JSON entirely. Batch runs always keep stores.",
+        type=Path,
+    )
     parser.add_argument(
         "-t", "--file-type",
         help="Choose from a limited set of options for ingestible filetypes.",
-        required=True,
-        choices=["coco-json", "diffgram-json", "colored-img", "H-json", "F-json"],
+        choices=["coco-json",
+                 "diffgram-json",
+                 "colored-img",
+                 "H-json",
+                 "F-json",
+                 "polygon-store"],
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of processes to rasterize multi-image files (or convert"
+             " batch inputs) with. Uses all cores if not given.",
+        type=int,
+        default=None,
     )
-    return parser.parse_args()
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.batch is None:
+        assert args.input_file is not None, "Need --input-file or --batch"
+        assert args.file_type is not None, "Need --file-type for --input-file"
+    else:
+        assert args.input_file is None, "Choose --input-file or --batch"
+
+    return args
 
 
 if __name__ == "__main__":
-    main(parse_args())
+    args = parse_args()
+    profiling.start("ingestion", args.profile, args.cprofile)
+    main(args)
+    profiling.finish()
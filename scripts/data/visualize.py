@@ -5,27 +5,72 @@ being the pixel value).
 
 import argparse
 import cv2
+from functools import lru_cache
 from matplotlib import pyplot
+from multiprocessing import Pool
+import numpy
 from pathlib import Path
+from PIL import Image
 
 
 def main(args):
-    for impath in args.input_dir.glob(f"*{args.filetype}"):
-        image = cv2.imread(str(impath), cv2.IMREAD_UNCHANGED)
+    # Decide where to save images
+    save_dir = args.out_dir
+    if save_dir is None:
+        save_dir = args.input_dir
 
-        # Scale things so classes show up consistently
-        image[0, 0] = args.num_classes
+    jobs = [
+        (impath,
+         save_dir.joinpath(impath.name.replace(
+             f".{args.filetype}",
+             f"_vis.{args.filetype}",
+         )),
+         args.colormap,
+         args.num_classes)
+        for impath in args.input_dir.glob(f"*{args.filetype}")
+    ]
+    with Pool(args.workers) as pool:
+        for _ in pool.imap_unordered(visualize_job, jobs):
+            pass
 
-        # Decide where to save images
-        save_dir = args.out_dir
-        if save_dir is None:
-            save_dir = args.input_dir
-        save_path = save_dir.joinpath(impath.name.replace(
-            f".{args.filetype}",
-            f"_vis.{args.filetype}",
-        ))
 
-        pyplot.imsave(save_path, image, cmap=args.colormap)
+def visualize_job(job):
+    '''Pool wrapper to colorize one (impath, save_path, colormap, top) job.'''
+    impath, save_path, colormap, top = job
+    image = cv2.imread(str(impath), cv2.IMREAD_UNCHANGED)
+    save_paletted(save_path, image, palette(colormap, top))
+
+
+@lru_cache(maxsize=None)
+def palette(colormap, top):
+    '''
+    Precompute the color of every possible label value. The colormap is spread
+    over values 0 to top, so classes show up consistently between images
+    without having to write top into the image, and anything above is clipped.
+
+    Arguments:
+        colormap: string name of a matplotlib colormap
+        top: pixel value that gets the last color of the colormap
+
+    Returns: (256, 3) uint8 array of RGB colors
+    '''
+    values = numpy.clip(numpy.arange(256) / top, 0, 1)
+    return pyplot.get_cmap(colormap)(values, bytes=True)[:, :3]
+
+
+def save_paletted(save_path, image, lut):
+    '''
+    Write a label image as a paletted PNG with the given (256, 3) palette. The
+    label pixels are written as they are, only the palette carries color.
+    Other formats (jpg can't hold a palette) get the colors written out as RGB.
+    '''
+    assert image.ndim == 2, f"Expected a label image, got {image.shape}"
+    assert image.min() >= 0 and image.max() < 256, "Labels don't fit in 8 bits"
+    paletted = Image.fromarray(image.astype(numpy.uint8, copy=False))
+    paletted.putpalette(lut.tobytes())
+    if Path(save_path).suffix.lower() != ".png":
+        paletted = paletted.convert("RGB")
+    paletted.save(save_path)
 
 
 def parse_args():
@@ -52,7 +97,8 @@ def parse_args():
     )
     parser.add_argument(
         "-n", "--num-classes",
-        help="Number of classes (making the max pixel value n-1).",
+        help="Number of classes, pixels with this value get the last color of"
+             " the colormap.",
         default=6,
         type=int,
     )
@@ -63,6 +109,13 @@ def parse_args():
         default=None,
         type=Path,
     )
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of processes to convert images with. Uses all cores if"
+             " not given.",
+        type=int,
+        default=None,
+    )
     args = parser.parse_args()
 
     assert args.input_dir.is_dir()
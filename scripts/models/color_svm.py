@@ -5,20 +5,42 @@ would be crazy and prohibitively expensive (according to the SVM docs more than
 there is a mechanism to downsample images by class. The cost grows
 quadratically with data size, apparently.
 
+To get past that there is also an approximate trainer, which maps pixels
+through an approximate RBF kernel feature map and trains a linear SVM on top
+of that in mini-batches, so it scales linearly and can use far more pixels.
+
+With --sweep, instead of training one model a grid (or random subset) of SVC
+settings is cross-validated in parallel on the same cached samples, and a
+table of timings and per-class accuracy is written out.
+
 The final output mechanism is still TODO depending on how experiments are run.
 '''
 
 import argparse
-from cProfile import Profile
+import csv
 import cv2
+import hashlib
+import json
 from joblib import dump, load
 import logging
 from matplotlib import pyplot
+from multiprocessing import Pool
 import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+import os
 from pathlib import Path
+import shutil
 from sklearn import svm
+from sklearn.kernel_approximation import Nystroem, RBFSampler
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import ParameterGrid, ParameterSampler, StratifiedKFold
+from sklearn.pipeline import make_pipeline
+import tempfile
 import time
 
+from scripts import profiling
+from scripts.models.svm_export import export
+
 
 # Modes, we can either treat a pixel as a single 3-element vector (RGB) or
 # treat it as a HxWx3 vector of RGBRGBRGB... in the area around it
@@ -26,33 +48,335 @@ SINGLE = "single"
 AREA = "area"
 # Square radius in pixels (center-radius:center+radius+1)
 AREA_RADIUS = 3
+# Take every AREA_STRIDE-th pixel in that square, so the same number of values
+# can cover a wider area (center-radius*stride:center+radius*stride+1:stride)
+AREA_STRIDE = 1
 
 CLASSES = [0, 1, 2, 3, 4, 5]
+# With a negative number per class, at most this many pixels of each class are
+# sampled from the whole dataset
+CLASS_BUDGET = 200000
+
+# Trainers, either the exact svm.SVC or a kernel approximation + linear SVM
+EXACT = "exact"
+APPROX = "approx"
+# Kernel feature maps for the approximate trainer
+NYSTROEM = "nystroem"
+FOURIER = "fourier"
+# Fraction of the samples held out to compare the trainers on
+HOLDOUT = 0.1
+# Number of samples the kernel feature map is fit on
+FEATURE_MAP_SAMPLES = 10000
+
+# svm.SVC settings swept over by default with --sweep
+SWEEP_GRID = {
+    "kernel": ["rbf", "linear"],
+    "C": [0.1, 1, 10],
+    "gamma": ["scale", 0.001, 0.01],
+}
+# The samples each sweep worker process memory maps, see load_sweep_worker
+WORKER = {}
+
+
+def main(datapath, mode, number, savedir, radius=AREA_RADIUS,
+         stride=AREA_STRIDE, seed=None, workers=None, cachedir=None,
+         trainer=EXACT, kernel_map=NYSTROEM, components=500,
+         batch_size=10000, epochs=3, svc_samples=10000, sweep=False,
+         grid=None, search=0, folds=3, budget=CLASS_BUDGET):
+
+    # Only a given seed can be repeated, so only then is caching worth it
+    if seed is None:
+        seed = numpy.random.SeedSequence().entropy
+        cachedir = None
+    if (sweep or trainer == APPROX) and cachedir is None:
+        # The sweep workers share the samples through .npy files, and the
+        # approximate trainer reads them in batches from a memory map so it
+        # doesn't need them all in memory, so they still need to go somewhere
+        temp = tempfile.TemporaryDirectory()
+        cachedir = Path(temp.name)
+    logging.info(f"Loading data with seed {seed}...")
+    with profiling.stage("load"):
+        if cachedir is None:
+            data, labels = load_data(datapath, mode, number, radius, stride,
+                                     seed, workers, budget)
+        else:
+            data, labels = cached_load_data(cachedir, datapath, mode, number,
+                                            radius, stride, seed, workers,
+                                            budget)
+
+    if sweep:
+        with profiling.stage("sweep"):
+            run_sweep(data, labels, savedir, grid, search, folds, seed,
+                      workers)
+        return
+
+    with profiling.stage("fit"):
+        if trainer == EXACT:
+            logging.info(f"Training SVC with {data.shape} data, {labels.shape} labels...")
+            classifier = svm.SVC()
+            classifier.fit(data, labels)
+        elif trainer == APPROX:
+            classifier = compare_approx(data, labels, kernel_map, components,
+                                        batch_size, epochs, svc_samples, seed)
+        else:
+            raise NotImplementedError()
 
+    with profiling.stage("save"):
+        savepath = savedir.joinpath(f"svm_{int(time.time() * 1e6)}.pth")
+        logging.info(f"Saving model to {savepath}")
+        dump(classifier, savepath)
+        # Plus the compact version inference loads much faster, see svm_export
+        export(classifier, savepath.with_suffix(".svm"), data)
 
-def main(datapath, mode, number, savedir):
 
-    logging.info("Loading data...")
-    data, labels = load_data(datapath, mode, number)
+def compare_approx(data, labels, kernel_map, components, batch_size, epochs,
+                   svc_samples, seed):
+    '''
+    Train the approximate model on all but a HOLDOUT fraction of the samples,
+    and an exact svm.SVC on up to svc_samples of the same training samples,
+    then log the wall time and held-out accuracy of both.
+
+    Returns: the trained approximate model
+    '''
+    rng = numpy.random.default_rng(seed)
+    order = rng.permutation(len(labels))
+    split = int(len(labels) * HOLDOUT)
+    test_rows = numpy.sort(order[:split])
+    train_rows = numpy.sort(order[split:])
+
+    logging.info(f"Training {kernel_map} + linear SVM on {len(train_rows)}"
+                 f" of {data.shape} data...")
+    start = time.time()
+    classifier = train_approx(data, labels, train_rows, kernel_map,
+                              components, batch_size, epochs, rng)
+    fit_time = time.time() - start
+    accuracy = batched_accuracy(classifier, data, labels, test_rows, batch_size)
+    logging.info(f"Approximate: fit {fit_time:.1f}s, held-out accuracy"
+                 f" {accuracy:.4f} on {len(test_rows)} samples")
+
+    if svc_samples > 0:
+        rows = numpy.sort(rng.choice(train_rows,
+                                     size=min(svc_samples, len(train_rows)),
+                                     replace=False))
+        logging.info(f"Training exact SVC on {len(rows)} samples to compare...")
+        start = time.time()
+        exact = svm.SVC()
+        exact.fit(data[rows], labels[rows])
+        fit_time = time.time() - start
+        accuracy = batched_accuracy(exact, data, labels, test_rows, batch_size)
+        logging.info(f"Exact SVC: fit {fit_time:.1f}s, held-out accuracy"
+                     f" {accuracy:.4f} on {len(test_rows)} samples")
 
-    logging.info(f"Training SVC with {data.shape} data, {labels.shape} labels...")
-    classifier = svm.SVC()
-    classifier.fit(data, labels)
+    return classifier
 
-    savepath = savedir.joinpath(f"svm_{int(time.time() * 1e6)}.pth")
-    logging.info(f"Saving model to {savepath}")
-    dump(classifier, savepath)
 
+def train_approx(data, labels, rows, kernel_map, components, batch_size,
+                 epochs, rng):
+    '''
+    Scalable stand-in for svm.SVC. Pixels go through an approximate RBF kernel
+    feature map (Nystroem or random Fourier features) and a linear SVM is
+    trained on that with mini-batch partial_fit. Only one batch is gathered
+    and transformed at a time, so with memory mapped data the memory use is
+    bounded by batch_size however many pixels were sampled.
+
+    Arguments:
+        data: (N, X) array of data, can be a memory map
+        labels: (N,) array of class labels
+        rows: indices of the samples to train on
+        kernel_map: NYSTROEM or FOURIER
+        components: dimension of the kernel feature map
+        batch_size: number of samples per partial_fit call
+        epochs: number of passes over the samples
+        rng: numpy.random.Generator for shuffling and the sklearn seeds
+
+    Returns: fitted sklearn Pipeline of (feature map, SGDClassifier)
+    '''
+    # Fit the feature map on a subsample, with gamma picked the same way as
+    # svm.SVC's default of "scale" does
+    sample = numpy.asarray(
+        data[numpy.sort(rng.choice(rows,
+                                   size=min(FEATURE_MAP_SAMPLES, len(rows)),
+                                   replace=False))],
+        dtype=float,
+    )
+    gamma = 1 / (sample.shape[1] * sample.var())
+    random_state = int(rng.integers(2**31))
+    if kernel_map == NYSTROEM:
+        feature_map = Nystroem(gamma=gamma,
+                               n_components=components,
+                               random_state=random_state)
+    elif kernel_map == FOURIER:
+        feature_map = RBFSampler(gamma=gamma,
+                                 n_components=components,
+                                 random_state=random_state)
+    else:
+        raise NotImplementedError()
+    feature_map.fit(sample)
+
+    linear = SGDClassifier(loss="hinge", random_state=random_state)
+    for epoch in range(epochs):
+        order = rng.permutation(rows)
+        for start in range(0, len(order), batch_size):
+            # Sorted reads are kinder to memory maps
+            batch = numpy.sort(order[start:start + batch_size])
+            linear.partial_fit(
+                feature_map.transform(numpy.asarray(data[batch], dtype=float)),
+                labels[batch],
+                classes=CLASSES,
+            )
+        logging.info(f"Finished epoch {epoch + 1}/{epochs}")
+
+    return make_pipeline(feature_map, linear)
+
+
+def run_sweep(data, labels, savedir, grid=None, search=0, folds=3, seed=0,
+              workers=None):
+    '''
+    Cross-validate svm.SVC settings in parallel and write a CSV table of the
+    results to savedir. Every (setting, fold) pair is a separate pool job, and
+    the workers memory map the cached samples read-only rather than getting a
+    copy each.
+
+    Arguments:
+        data: (N, X) memory mapped array of data, from cached_load_data
+        labels: (N,) memory mapped array of class labels
+        savedir: directory to write sweep_<time>.csv in
+        grid: dict of SVC argument name to list of values, SWEEP_GRID if None
+        search: if positive, try this many random settings from the grid
+            instead of all of them
+        folds: number of stratified cross-validation folds
+        seed: integer seed for the folds and the random search
+        workers: number of processes to fit with, all cores if None
+
+    Returns: path of the written table
+    '''
+    if grid is None:
+        grid = SWEEP_GRID
+    if search > 0:
+        settings = list(ParameterSampler(grid, search, random_state=seed % 2**32))
+    else:
+        settings = list(ParameterGrid(grid))
+    splits = list(StratifiedKFold(folds, shuffle=True, random_state=seed % 2**32)
+                  .split(numpy.zeros(len(labels)), labels))
+    logging.info(f"Sweeping {len(settings)} settings x {folds} folds over"
+                 f" {data.shape} data...")
+
+    jobs = [
+        (i, params, train_rows, test_rows)
+        for i, params in enumerate(settings)
+        for train_rows, test_rows in splits
+    ]
+    # Sum (fit time, predict time, correct per class, total per class) over
+    # the folds of each setting
+    totals = [[0.0, 0.0, numpy.zeros(len(CLASSES)), numpy.zeros(len(CLASSES))]
+              for _ in settings]
+    with Pool(workers,
+              initializer=load_sweep_worker,
+              initargs=(data.filename, labels.filename)) as pool:
+        for i, fit_time, predict_time, correct, total in \
+                pool.imap_unordered(sweep_job, jobs):
+            totals[i][0] += fit_time
+            totals[i][1] += predict_time
+            totals[i][2] += correct
+            totals[i][3] += total
+            logging.info(f"Fold done for {settings[i]}")
+
+    savepath = savedir.joinpath(f"sweep_{int(time.time() * 1e6)}.csv")
+    names = sorted({name for params in settings for name in params})
+    with savepath.open("w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(names
+                        + ["fit_s", "predict_s", "accuracy"]
+                        + [f"accuracy_{classid}" for classid in CLASSES])
+        for params, (fit_time, predict_time, correct, total) in \
+                zip(settings, totals):
+            per_class = correct / numpy.maximum(total, 1)
+            writer.writerow([params.get(name, "") for name in names]
+                            + [f"{fit_time / folds:.3f}",
+                               f"{predict_time / folds:.3f}",
+                               f"{correct.sum() / total.sum():.4f}"]
+                            + [f"{value:.4f}" if count > 0 else ""
+                               for value, count in zip(per_class, total)])
+    logging.info(f"Saved sweep results to {savepath}")
+    return savepath
+
+
+def load_sweep_worker(datafile, labelfile):
+    '''Pool initializer, memory maps the shared samples once per worker.'''
+    WORKER["data"] = numpy.load(datafile, mmap_mode="r")
+    WORKER["labels"] = numpy.load(labelfile, mmap_mode="r")
+
+
+def sweep_job(job):
+    '''
+    Fit and score one SVC setting on one cross-validation fold.
+
+    Arguments:
+        job: (setting index, SVC arguments, train rows, test rows)
 
-def load_data(datapath, mode, number):
+    Returns: (setting index, fit seconds, predict seconds, (K,) correct
+        predictions per class, (K,) test samples per class)
+    '''
+    i, params, train_rows, test_rows = job
+    data = WORKER["data"]
+    labels = WORKER["labels"]
+
+    start = time.time()
+    classifier = svm.SVC(**params)
+    classifier.fit(data[train_rows], labels[train_rows])
+    fit_time = time.time() - start
+
+    truth = numpy.asarray(labels[test_rows])
+    start = time.time()
+    predicted = classifier.predict(data[test_rows])
+    predict_time = time.time() - start
+
+    total = numpy.bincount(truth, minlength=max(CLASSES) + 1)[CLASSES]
+    correct = numpy.bincount(truth[predicted == truth],
+                             minlength=max(CLASSES) + 1)[CLASSES]
+    return i, fit_time, predict_time, correct, total
+
+
+def batched_accuracy(classifier, data, labels, rows, batch_size):
+    '''Fraction of correct predictions on the given (sorted) rows, gathering
+    and predicting batch_size of them at a time.'''
+    correct = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        predicted = classifier.predict(numpy.asarray(data[batch], dtype=float))
+        correct += numpy.count_nonzero(predicted == labels[batch])
+    return correct / max(len(rows), 1)
+
+
+def load_data(datapath, mode, number, radius=AREA_RADIUS, stride=AREA_STRIDE,
+              seed=0, workers=None, budget=CLASS_BUDGET, scratch=None):
     '''
     We want to load images from the cityscapes format because that's what we
     are already working with for mmsegmentation code. Randomly sample a certain
-    number per class per image.
+    number per class per image. Images are decoded and sampled in a process
+    pool, each with its own random generator derived from the seed and the
+    image's index, so the result is the same for any number of workers.
+
+    With a negative number, pixels are instead sampled uniformly out of all the
+    pixels of each class in the dataset, up to budget of them per class, so
+    class balance is decided across the dataset instead of per image. This is
+    a reservoir sample: every pixel gets a random key and the budget smallest
+    keys of each class are kept as the images stream in, so memory stays
+    fixed however many images there are. See reservoir_pixels and
+    keep_smallest.
 
     Arguments:
         datapath: Base cityscapes format folder from which to draw images
-        number: Number that we want to sample from each class, per picture
+        number: Number that we want to sample from each class, per picture,
+            or negative to sample from the whole dataset
+        radius: For AREA mode, see AREA_RADIUS
+        stride: For AREA mode, see AREA_STRIDE
+        seed: Integer seed for the sampling
+        workers: Number of processes to load with, all cores if None
+        budget: With a negative number, see CLASS_BUDGET
+        scratch: Optional directory to collect the samples in on disk, as
+            memory maps, instead of in memory. Only needed for a positive
+            number, the reservoir is already bounded by the budget
 
     Returns: two-element tuple of numpy arrays:
         [0]: size (N, X) array of data, where X is 3 or 3xHxW depending on mode
@@ -61,52 +385,303 @@ def load_data(datapath, mode, number):
 
     imgs = datapath.joinpath("img_dir", "train")
     anns = datapath.joinpath("ann_dir", "train")
-    data = []
-    labels = []
-    for i, (imgpath, annpath) in enumerate(
-                zip(sorted(imgs.glob("*png")),
-                    sorted(anns.glob("*png")))
-            ):
+    pairs = list(zip(sorted(imgs.glob("*png")), sorted(anns.glob("*png"))))
+
+    # Preallocate for the most we could sample and trim at the end
+    if mode == SINGLE:
+        width = 3
+    elif mode == AREA:
+        width = 3 * (2 * radius + 1)**2
+    else:
+        raise NotImplementedError()
+    if number >= 0:
+        rows = len(pairs) * len(CLASSES) * number
+        if scratch is None:
+            data = numpy.empty((rows, width), dtype=numpy.uint8)
+            labels = numpy.empty(rows, dtype=numpy.uint8)
+        else:
+            data = numpy.memmap(scratch.joinpath("data.raw"), mode="w+",
+                                dtype=numpy.uint8, shape=(max(rows, 1), width))
+            labels = numpy.memmap(scratch.joinpath("labels.raw"), mode="w+",
+                                  dtype=numpy.uint8, shape=max(rows, 1))
+        filled = 0
+    else:
+        # Per class (keys, vectors) of the pixels kept so far
+        reservoir = {
+            classid: (numpy.zeros(0), numpy.zeros((0, width), dtype=numpy.uint8))
+            for classid in CLASSES
+        }
+
+    jobs = [
+        (imgpath,
+         annpath,
+         mode,
+         number,
+         budget,
+         radius,
+         stride,
+         numpy.random.SeedSequence(seed, spawn_key=(i,)))
+        for i, (imgpath, annpath) in enumerate(pairs)
+    ]
+    with Pool(workers) as pool:
+        # imap keeps the image order, which keeps the output deterministic
+        for i, (vectors, classes, keys, stages) in \
+                enumerate(pool.imap(load_job, jobs)):
+            profiling.merge(stages)
+
+            if i % 20 == 0:
+                logging.info(f"Loaded {pairs[i][0].name}, {pairs[i][1].name}")
+
+            if number >= 0:
+                data[filled:filled + len(classes)] = vectors
+                labels[filled:filled + len(classes)] = classes
+                filled += len(classes)
+            else:
+                for classid in CLASSES:
+                    mask = classes == classid
+                    reservoir[classid] = keep_smallest(reservoir[classid],
+                                                       keys[mask],
+                                                       vectors[mask],
+                                                       budget)
+
+    if number >= 0:
+        return data[:filled], labels[:filled]
+    return (numpy.concatenate([reservoir[classid][1] for classid in CLASSES]),
+            numpy.concatenate([numpy.full(len(reservoir[classid][0]), classid,
+                                          dtype=numpy.uint8)
+                               for classid in CLASSES]))
+
+
+def keep_smallest(kept, keys, vectors, budget):
+    '''
+    Add pixels to one class's reservoir, keeping the budget with the smallest
+    keys out of the old and new ones.
+
+    Arguments:
+        kept: (keys, vectors) tuple of the reservoir so far
+        keys: (M,) random keys of the new pixels
+        vectors: (M, X) data of the new pixels
+        budget: most pixels to keep
+
+    Returns: updated (keys, vectors) tuple
+    '''
+    old_keys, old_vectors = kept
+    # Once the reservoir is full only keys below its largest can get in,
+    # which quickly becomes very few of them
+    if len(old_keys) >= budget:
+        mask = keys < old_keys.max()
+        keys = keys[mask]
+        vectors = vectors[mask]
+    if len(keys) == 0:
+        return kept
+
+    keys = numpy.concatenate([old_keys, keys])
+    vectors = numpy.concatenate([old_vectors, vectors])
+    if len(keys) > budget:
+        keep = numpy.argpartition(keys, budget - 1)[:budget]
+        keys = keys[keep]
+        vectors = vectors[keep]
+    return keys, vectors
+
+
+def cached_load_data(cachedir, datapath, mode, number, radius=AREA_RADIUS,
+                     stride=AREA_STRIDE, seed=0, workers=None,
+                     budget=CLASS_BUDGET):
+    '''
+    Same as load_data, but the arrays are saved as .npy files under cachedir
+    the first time and memory mapped (read-only) after that. The cache key
+    covers the dataset listing and mtimes plus all the sampling settings, so
+    any change to those samples afresh. Several runs can share one copy.
+    '''
+    directory = cachedir.joinpath(
+        cache_key(datapath, mode, number, radius, stride, seed, budget)
+    )
+    if not directory.joinpath("labels.npy").is_file():
+        # Write somewhere private and rename into place, so concurrent runs
+        # never see a half written cache
+        temp = cachedir.joinpath(f".{directory.name}.{os.getpid()}")
+        temp.mkdir(parents=True)
+        # The samples are collected in memory maps in there too, and saved
+        # from those a page at a time, so they never all have to be in memory
+        data, labels = load_data(datapath, mode, number, radius, stride, seed,
+                                 workers, budget, scratch=temp)
+        numpy.save(temp.joinpath("data.npy"), data)
+        numpy.save(temp.joinpath("labels.npy"), labels)
+        del data, labels
+        for path in temp.glob("*.raw"):
+            path.unlink()
+        try:
+            temp.rename(directory)
+        except OSError:
+            # Someone else got there first, theirs is the same
+            shutil.rmtree(temp)
+    logging.info(f"Using cached samples in {directory}")
+    return (numpy.load(directory.joinpath("data.npy"), mmap_mode="r"),
+            numpy.load(directory.joinpath("labels.npy"), mmap_mode="r"))
+
 
-        if i % 20 == 0:
-            logging.info(f"Loading {imgpath.name}, {annpath.name}")
+def cache_key(datapath, mode, number, radius, stride, seed,
+              budget=CLASS_BUDGET):
+    '''Hash of everything that decides what load_data returns.'''
+    files = [
+        (str(path.relative_to(datapath)),
+         path.stat().st_mtime_ns,
+         path.stat().st_size)
+        for split in ("img_dir", "ann_dir")
+        for path in sorted(datapath.joinpath(split, "train").glob("*png"))
+    ]
+    settings = {
+        "files": files,
+        "mode": mode,
+        "number": number,
+        "seed": seed,
+        "classes": CLASSES,
+    }
+    if mode == AREA:
+        settings["radius"] = radius
+        settings["stride"] = stride
+    if number < 0:
+        settings["budget"] = budget
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
 
+
+def load_job(job):
+    '''
+    Decode and sample one image/annotation pair for load_data.
+
+    Arguments:
+        job: (imgpath, annpath, mode, number, budget, radius, stride,
+              seed_sequence)
+
+    Returns: four-element tuple, (data, labels, keys) numpy arrays for this
+        image and the profiling stages of the job. keys are the reservoir keys
+        with a negative number, otherwise None
+    '''
+    imgpath, annpath, mode, number, budget, radius, stride, seed_sequence = job
+    with profiling.stage("decode"):
         img = cv2.imread(str(imgpath), cv2.IMREAD_UNCHANGED)
         ann = cv2.imread(str(annpath), cv2.IMREAD_UNCHANGED)
-        for classid in CLASSES:
-            # argwhere is the time sink
-            pixels = numpy.argwhere(ann == classid)
-            # Skip the cases where there were none of that class
-            if len(pixels) == 0:
-                continue
-
-            # randint could conceivably lead to some double-samples, but the
-            # sample numbers are so low I think that's okay. It's much faster
-            # than random.choice(range())
-            if pixels.shape[0] <= number:
-                indices = range(pixels.shape[0])
-            else:
-                indices = numpy.random.randint(0, pixels.shape[0], size=number)
-
-            for index in indices:
-                px = pixels[index]
-                if mode == SINGLE:
-                    data.append(img[px[0], px[1]])
-                    labels.append(ann[px[0], px[1]])
-                elif mode == AREA:
-                    vector = img[
-                        px[0]-AREA_RADIUS:px[0]+AREA_RADIUS+1,
-                        px[1]-AREA_RADIUS:px[1]+AREA_RADIUS+1
-                    ].flatten()
-                    # If the vector isn't the right length it may be because
-                    # the pixel was sampled along the image edge. Just skip it.
-                    if len(vector) == 3 * (2 * AREA_RADIUS + 1)**2:
-                        data.append(vector)
-                        labels.append(ann[px[0], px[1]])
-                else:
-                    raise NotImplementedError()
-
-    return numpy.array(data), numpy.array(labels)
+    with profiling.stage("sample"):
+        rng = numpy.random.default_rng(seed_sequence)
+        if number >= 0:
+            chosen = sample_pixels(ann, number, rng)
+            keys = None
+        else:
+            chosen, keys = reservoir_pixels(ann, budget, rng)
+
+        if mode == SINGLE:
+            vectors = img.reshape(-1, 3)[chosen]
+        elif mode == AREA:
+            rows, cols = numpy.divmod(chosen, ann.shape[1])
+            vectors = extract_patches(img, rows, cols, radius, stride)
+
+    return vectors, ann.ravel()[chosen], keys, profiling.collect()
+
+
+def extract_patches(img, rows, cols, radius=AREA_RADIUS, stride=AREA_STRIDE):
+    '''
+    Gather the square neighborhoods around a set of pixels as flat vectors in
+    one fancy-indexing operation, out of a sliding window view of the image.
+    The image is reflect padded first so pixels along the edge get a full
+    neighborhood instead of being dropped.
+
+    Arguments:
+        img: (H, W, 3) image
+        rows: (N,) row of each center pixel
+        cols: (N,) column of each center pixel
+        radius: see AREA_RADIUS
+        stride: see AREA_STRIDE
+
+    Returns: (N, 3 * (2 * radius + 1)**2) array, each vector laid out like
+        img[row-radius:row+radius+1, col-radius:col+radius+1].flatten() would
+        be for a stride of 1
+    '''
+    reach = radius * stride
+    padded = numpy.pad(img, ((reach, reach), (reach, reach), (0, 0)),
+                       mode="reflect")
+    # (H, W, 3, side, side) view, nothing is copied until the gather
+    windows = sliding_window_view(padded,
+                                  (2 * reach + 1, 2 * reach + 1),
+                                  axis=(0, 1))[..., ::stride, ::stride]
+    patches = windows[rows, cols]
+    return patches.transpose(0, 2, 3, 1).reshape(len(rows), -1)
+
+
+def sample_pixels(ann, number, rng):
+    '''
+    Randomly sample pixels of each class in CLASSES from a label image, all
+    of them if there are no more than number, otherwise number of them.
+
+    Arguments:
+        ann: (H, W) integer label image
+        number: Number that we want to sample from each class
+        rng: numpy.random.Generator to sample with
+
+    Returns: (M,) array of flat (row-major) indices into ann
+    '''
+    chosen = []
+    for bucket in class_buckets(ann):
+        # Skip the cases where there were none of that class
+        if len(bucket) == 0:
+            continue
+
+        # integers could conceivably lead to some double-samples, but the
+        # sample numbers are so low I think that's okay. It's much faster
+        # than choice without replacement
+        if len(bucket) <= number:
+            chosen.append(bucket)
+        else:
+            chosen.append(bucket[rng.integers(0, len(bucket), size=number)])
+
+    if len(chosen) == 0:
+        return numpy.zeros(0, dtype=int)
+    return numpy.concatenate(chosen)
+
+
+def reservoir_pixels(ann, budget, rng):
+    '''
+    Give every pixel of each class in CLASSES a uniform random key, and pick
+    out the budget pixels of each class with the smallest keys. Only those
+    could make it into the dataset-wide reservoir, see keep_smallest.
+
+    Arguments:
+        ann: (H, W) integer label image
+        budget: most pixels to pick per class
+        rng: numpy.random.Generator for the keys
+
+    Returns: two-element tuple of (M,) arrays, the flat (row-major) indices
+        into ann and their keys
+    '''
+    chosen = [numpy.zeros(0, dtype=int)]
+    keys = [numpy.zeros(0)]
+    for bucket in class_buckets(ann):
+        bucket_keys = rng.random(len(bucket))
+        if len(bucket) > budget:
+            keep = numpy.argpartition(bucket_keys, budget - 1)[:budget]
+            bucket = bucket[keep]
+            bucket_keys = bucket_keys[keep]
+        chosen.append(bucket)
+        keys.append(bucket_keys)
+    return numpy.concatenate(chosen), numpy.concatenate(keys)
+
+
+def class_buckets(ann):
+    '''
+    Flat indices of the pixels of each class in CLASSES, in that order.
+
+    Arguments:
+        ann: (H, W) integer label image
+
+    Returns: list of (M_class,) arrays of flat (row-major) indices into ann
+    '''
+    flat = ann.ravel()
+    # A stable sort of small integers is a radix sort, so this buckets every
+    # pixel by class in one pass and keeps them in row-major order within each
+    # bucket (the same order numpy.argwhere gives)
+    order = numpy.argsort(flat, kind="stable")
+    counts = numpy.bincount(flat, minlength=max(CLASSES) + 1)
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)))
+    return [order[starts[classid]:starts[classid + 1]] for classid in CLASSES]
 
 
 def parse_args():
@@ -114,32 +689,150 @@ def parse_args():
         description=__doc__,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
+    parser.add_argument(
+        "-a", "--trainer",
+        help="Train an exact SVC, or the approximate kernel map + linear SVM"
+             " (which also reports how it compares to an exact SVC).",
+        default=EXACT,
+        choices=[EXACT, APPROX],
+    )
+    parser.add_argument(
+        "-b", "--batch-size",
+        help="For the approximate trainer, samples per mini-batch. The samples"
+             " are memory mapped from --cache-dir (or a temporary directory"
+             " without a seed), so this bounds the memory used in training.",
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "-c", "--cache-dir",
+        help="Directory to cache the sampled data in, so runs with the same"
+             " data, settings and --seed skip loading. Only used with a seed.",
+        default=Path("/tmp/svm_cache/"),
+        type=Path,
+    )
+    parser.add_argument(
+        "--class-budget",
+        help="With a negative --number-per-class, the most pixels of each"
+             " class to sample from the whole dataset. Bounds the memory used.",
+        type=int,
+        default=CLASS_BUDGET,
+    )
     parser.add_argument(
         "-d", "--data-path",
         help="Base folder in the cityscapes format from which to draw images.",
         required=True,
         type=Path,
     )
+    parser.add_argument(
+        "-e", "--epochs",
+        help="For the approximate trainer, passes over the samples.",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "-k", "--kernel-map",
+        help="For the approximate trainer, which kernel feature map to use.",
+        default=NYSTROEM,
+        choices=[NYSTROEM, FOURIER],
+    )
+    parser.add_argument(
+        "--components",
+        help="For the approximate trainer, dimension of the kernel map.",
+        type=int,
+        default=500,
+    )
     parser.add_argument(
         "-m", "--mode",
         help="Choose between single-pixel and area-based classification.",
         default=SINGLE,
         choices=[SINGLE, AREA],
     )
+    parser.add_argument(
+        "-r", "--area-radius",
+        help="In area mode, square radius in pixels around each pixel.",
+        type=int,
+        default=AREA_RADIUS,
+    )
+    parser.add_argument(
+        "-t", "--area-stride",
+        help="In area mode, take every nth pixel within the radius, so a wider"
+             " area is covered with the same number of values.",
+        type=int,
+        default=AREA_STRIDE,
+    )
     parser.add_argument(
         "-n", "--number-per-class",
         help="Number of pixels to randomly select per-class, per image."
-             " Negative number means take all pixels.",
+             " A negative number samples from all the pixels in the dataset"
+             " instead, up to --class-budget per class.",
         type=int,
         default=200,
     )
+    parser.add_argument(
+        "-p", "--seed",
+        help="Seed for the pixel sampling. A random one is picked (and logged)"
+             " if not given.",
+        type=int,
+        default=None,
+    )
     parser.add_argument(
         "-s", "--save-dir",
         help="Directory in which to save the output model.",
         default=Path("/tmp/"),
         type=Path,
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--sweep",
+        help="Instead of training a model, cross-validate a grid of exact SVC"
+             " settings in parallel and save a table of the results. Can't be"
+             " combined with --trainer approx.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sweep-grid",
+        help="JSON file of {SVC argument: [values]} to sweep over. Defaults to"
+             " a small grid of kernel, C and gamma.",
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--sweep-search",
+        help="If positive, sweep this many random settings from the grid"
+             " instead of all of them.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--sweep-folds",
+        help="Number of cross-validation folds in the sweep.",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--svc-samples",
+        help="For the approximate trainer, how many samples to train the exact"
+             " SVC it is compared against on. 0 skips the comparison.",
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of processes to load images with. Uses all cores if not"
+             " given.",
+        type=int,
+        default=None,
+    )
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    assert args.class_budget > 0, "--class-budget has to be positive"
+    assert not (args.sweep and args.trainer == APPROX), \
+        "--sweep only sweeps exact SVC settings, not --trainer approx"
+    if args.sweep_grid is not None:
+        args.sweep_grid = json.loads(args.sweep_grid.read_text())
+
+    return args
 
 
 if __name__ == "__main__":
@@ -151,8 +844,26 @@ if __name__ == "__main__":
     )
 
     args = parse_args()
+    profiling.start("color_svm", args.profile, args.cprofile)
     main(datapath=args.data_path,
          mode=args.mode,
          number=args.number_per_class,
          savedir=args.save_dir,
+         radius=args.area_radius,
+         stride=args.area_stride,
+         seed=args.seed,
+         workers=args.workers,
+         cachedir=args.cache_dir,
+         trainer=args.trainer,
+         kernel_map=args.kernel_map,
+         components=args.components,
+         batch_size=args.batch_size,
+         epochs=args.epochs,
+         svc_samples=args.svc_samples,
+         sweep=args.sweep,
+         grid=args.sweep_grid,
+         search=args.sweep_search,
+         folds=args.sweep_folds,
+         budget=args.class_budget,
          )
+    profiling.finish()
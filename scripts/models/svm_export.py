@@ -0,0 +1,339 @@
+'''
+Compact export of the models color_svm.py trains. A joblib pickle has to
+rebuild the whole sklearn object graph every time it is loaded, which is slow
+to start and gives every process its own copy. The exported file is instead a
+small JSON header followed by the model's float32 arrays, which CompactSVM
+memory maps, so loading takes milliseconds and processes using the same file
+share its pages. CompactSVM has a vectorized predict for inference that gives
+the same answers as the original model, up to float32 rounding on near-ties.
+
+Supports svm.SVC models (any of the builtin kernels) and the approximate
+trainer's pipelines of a Nystroem or RBFSampler feature map and a linear
+SGDClassifier.
+'''
+
+import argparse
+from joblib import load
+import json
+import logging
+import numpy
+from pathlib import Path
+from sklearn.kernel_approximation import Nystroem, RBFSampler
+from sklearn.pipeline import Pipeline
+from sklearn.svm import SVC
+
+
+# Identifies the file format, followed by the header length as a uint64
+MAGIC = b"SVMEXPT1"
+# Arrays start on multiples of this many bytes so they can be viewed in place
+ALIGNMENT = 64
+# Number of pixels an export is checked against the original model on, and the
+# fraction of them that has to come out the same (float32 can flip near-ties)
+CHECK_SAMPLES = 10000
+CHECK_AGREEMENT = 0.999
+
+
+def export(classifier, path, samples=None):
+    '''
+    Save a trained model in the compact format, then check that the exported
+    model predicts the same labels as the original.
+
+    Arguments:
+        classifier: svm.SVC or approximate trainer Pipeline, see the docstring
+        path: where to write the file
+        samples: (N, n_features) pixel vectors to check the predictions on,
+            if None CHECK_SAMPLES random pixel values are used
+
+    Returns: path
+    '''
+    header, arrays = describe(classifier)
+
+    # Work out where each array goes after the header, which in turn needs to
+    # know how long the header is, so lay the arrays out relative to the start
+    # of the data section
+    offset = 0
+    header["arrays"] = {}
+    for name, array in arrays.items():
+        header["arrays"][name] = {"shape": list(array.shape), "offset": offset}
+        offset += aligned(array.nbytes)
+    encoded = json.dumps(header).encode()
+    start = aligned(len(MAGIC) + 8 + len(encoded))
+
+    with open(path, "wb") as outfile:
+        outfile.write(MAGIC)
+        outfile.write(numpy.uint64(len(encoded)).tobytes())
+        outfile.write(encoded)
+        outfile.write(bytes(start - outfile.tell()))
+        for name, array in arrays.items():
+            outfile.write(array.tobytes())
+            outfile.write(bytes(aligned(array.nbytes) - array.nbytes))
+
+    check_export(classifier, CompactSVM(path), samples)
+    return path
+
+
+def check_export(classifier, compact, samples=None):
+    '''
+    Assert that an exported model agrees with the original on at least
+    CHECK_AGREEMENT of the sample pixels.
+
+    Returns: fraction of the samples that agree
+    '''
+    if samples is None:
+        rng = numpy.random.default_rng(0)
+        samples = rng.integers(0, 256, size=(CHECK_SAMPLES,
+                                             compact.n_features_in_))
+    # Spread out over the samples, which tend to come grouped by class
+    step = max(1, len(samples) // CHECK_SAMPLES)
+    samples = numpy.asarray(samples[::step][:CHECK_SAMPLES], dtype=float)
+    expected = classifier.predict(samples)
+    agreement = numpy.mean(compact.predict(samples) == expected)
+    logging.info(f"Export agrees with the model on {100 * agreement:.2f}% of"
+                 f" {len(samples)} pixels")
+    assert agreement >= CHECK_AGREEMENT, \
+        f"Export only agrees with the model on {100 * agreement:.2f}% of pixels"
+    return agreement
+
+
+def describe(classifier):
+    '''
+    Split a model into a JSON-able header and a dict of float32 arrays.
+
+    Returns: (header dict, {name: C-contiguous float32 array})
+    '''
+    def floats(array):
+        return numpy.ascontiguousarray(array, dtype=numpy.float32)
+
+    if isinstance(classifier, SVC):
+        dual_coef = classifier.dual_coef_
+        intercept = classifier.intercept_
+        # sklearn flips the signs for two classes, undo that to get back the
+        # libsvm one-vs-one convention used for more classes
+        if len(classifier.classes_) == 2:
+            dual_coef = -dual_coef
+            intercept = -intercept
+        header = {
+            "type": "svc",
+            "classes": classifier.classes_.tolist(),
+            "n_features": int(classifier.n_features_in_),
+            "n_support": classifier.n_support_.tolist(),
+            "kernel": kernel_header(classifier.kernel,
+                                    classifier._gamma,
+                                    classifier.degree,
+                                    classifier.coef0),
+        }
+        arrays = {
+            "support_vectors": floats(classifier.support_vectors_),
+            "dual_coef": floats(dual_coef),
+            "intercept": floats(intercept),
+        }
+
+    elif isinstance(classifier, Pipeline) and len(classifier.steps) == 2:
+        feature_map, linear = (step for _, step in classifier.steps)
+        header = {
+            "classes": linear.classes_.tolist(),
+            "n_features": int(feature_map.n_features_in_),
+        }
+        arrays = {
+            "coef": floats(linear.coef_),
+            "intercept": floats(linear.intercept_),
+        }
+        if isinstance(feature_map, Nystroem):
+            # The linear model only ever sees kernel @ normalization.T, so fold
+            # the normalization into its weights. That saves a product and
+            # keeps float32 from choking on badly conditioned normalizations
+            arrays["coef"] = floats(linear.coef_ @ feature_map.normalization_)
+            params = feature_map.get_params()
+            header["type"] = "nystroem"
+            header["kernel"] = kernel_header(params["kernel"],
+                                             params["gamma"],
+                                             params["degree"],
+                                             params["coef0"])
+            arrays["components"] = floats(feature_map.components_)
+        elif isinstance(feature_map, RBFSampler):
+            header["type"] = "fourier"
+            arrays["random_weights"] = floats(feature_map.random_weights_)
+            arrays["random_offset"] = floats(feature_map.random_offset_)
+        else:
+            raise NotImplementedError(f"Can't export {feature_map}")
+
+    else:
+        raise NotImplementedError(f"Can't export {classifier}")
+
+    return header, arrays
+
+
+def kernel_header(kernel, gamma, degree, coef0):
+    '''The kernel settings as they go in the header.'''
+    assert kernel in ("linear", "poly", "rbf", "sigmoid"), \
+        f"Can't export the {kernel} kernel"
+    # None (for Nystroem) means the sklearn.metrics.pairwise defaults
+    return {
+        "name": kernel,
+        "gamma": None if gamma is None else float(gamma),
+        "degree": 3.0 if degree is None else float(degree),
+        "coef0": 1.0 if coef0 is None else float(coef0),
+    }
+
+
+def aligned(nbytes):
+    '''Round nbytes up to a multiple of ALIGNMENT.'''
+    return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+
+class CompactSVM:
+    '''
+    Read-only model loaded from an exported file. The arrays are views into a
+    memory map of the file, nothing is copied or unpickled.
+    '''
+    def __init__(self, path):
+        raw = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+        assert bytes(raw[:len(MAGIC)]) == MAGIC, f"{path} isn't an exported model"
+        length = int(raw[len(MAGIC):len(MAGIC) + 8].view(numpy.uint64)[0])
+        header_end = len(MAGIC) + 8 + length
+        self.header = json.loads(bytes(raw[len(MAGIC) + 8:header_end]))
+        start = aligned(header_end)
+
+        self.arrays = {}
+        for name, layout in self.header["arrays"].items():
+            count = int(numpy.prod(layout["shape"]))
+            offset = start + layout["offset"]
+            self.arrays[name] = raw[offset:offset + 4 * count] \
+                .view(numpy.float32).reshape(layout["shape"])
+
+        self.classes_ = numpy.array(self.header["classes"])
+        self.n_features_in_ = self.header["n_features"]
+        # Rows that each pixel gets a kernel value against, which is what
+        # svm_inference sizes its batches from
+        if self.header["type"] == "svc":
+            self.support_vectors_ = self.arrays["support_vectors"]
+        elif self.header["type"] == "nystroem":
+            self.support_vectors_ = self.arrays["components"]
+        else:
+            self.support_vectors_ = self.arrays["random_weights"].T
+
+    def predict(self, data):
+        '''
+        Arguments:
+            data: (N, n_features) array
+
+        Returns: (N,) array of predicted classes
+        '''
+        data = numpy.asarray(data, dtype=numpy.float32)
+        if self.header["type"] == "svc":
+            return self.classes_[self.vote(data)]
+
+        if self.header["type"] == "nystroem":
+            features = self.kernel(data, self.arrays["components"])
+        else:
+            features = data @ self.arrays["random_weights"]
+            features += self.arrays["random_offset"]
+            numpy.cos(features, out=features)
+            features *= numpy.float32(
+                (2.0 / self.arrays["random_weights"].shape[1]) ** 0.5
+            )
+        scores = features @ self.arrays["coef"].T + self.arrays["intercept"]
+        if scores.shape[1] == 1:
+            return self.classes_[(scores[:, 0] > 0).astype(int)]
+        return self.classes_[numpy.argmax(scores, axis=1)]
+
+    def vote(self, data):
+        '''
+        One-vs-one votes of the SVC the way libsvm counts them, with ties
+        going to the earlier class.
+
+        Returns: (N,) index into classes_ of the winning class
+        '''
+        kernel = self.kernel(data, self.arrays["support_vectors"])
+        dual_coef = self.arrays["dual_coef"]
+        intercept = self.arrays["intercept"]
+        bounds = numpy.concatenate(([0], numpy.cumsum(self.header["n_support"])))
+
+        number = len(self.classes_)
+        votes = numpy.zeros((len(data), number), dtype=numpy.int32)
+        pair = 0
+        for i in range(number):
+            rows_i = slice(bounds[i], bounds[i + 1])
+            for j in range(i + 1, number):
+                rows_j = slice(bounds[j], bounds[j + 1])
+                decision = kernel[:, rows_i] @ dual_coef[j - 1, rows_i] \
+                    + kernel[:, rows_j] @ dual_coef[i, rows_j] \
+                    + intercept[pair]
+                winner = decision > 0
+                votes[winner, i] += 1
+                votes[~winner, j] += 1
+                pair += 1
+        return numpy.argmax(votes, axis=1)
+
+    def kernel(self, data, basis):
+        '''(N, M) kernel values between data and the basis rows, in float32.'''
+        settings = self.header["kernel"]
+        gamma = settings["gamma"]
+        if gamma is None:
+            gamma = 1.0 / data.shape[1]
+        gamma = numpy.float32(gamma)
+
+        dot = data @ basis.T
+        if settings["name"] == "linear":
+            return dot
+        if settings["name"] == "rbf":
+            # |x - y|^2 = |x|^2 + |y|^2 - 2 x.y, done in place on dot
+            dot *= -2
+            dot += numpy.einsum("ij,ij->i", data, data)[:, None]
+            dot += numpy.einsum("ij,ij->i", basis, basis)[None, :]
+            numpy.maximum(dot, 0, out=dot)
+            dot *= -gamma
+            return numpy.exp(dot, out=dot)
+        dot *= gamma
+        dot += numpy.float32(settings["coef0"])
+        if settings["name"] == "poly":
+            return dot ** numpy.float32(settings["degree"])
+        return numpy.tanh(dot, out=dot)
+
+
+def load_model(path):
+    '''Load either an exported model or a joblib pickled one.'''
+    with open(path, "rb") as infile:
+        if infile.read(len(MAGIC)) == MAGIC:
+            return CompactSVM(path)
+    return load(path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-m", "--model",
+        help="Model pickled by color_svm.py.",
+        required=True,
+        type=Path,
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="Where to write the exported model. Defaults to the model path"
+             " with a .svm suffix.",
+        default=None,
+        type=Path,
+    )
+    args = parser.parse_args()
+
+    assert args.model.is_file()
+    if args.output is None:
+        args.output = args.model.with_suffix(".svm")
+
+    return args
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    args = parse_args()
+    export(load(args.model), args.output)
+    logging.info(f"Exported {args.model} to {args.output}")
@@ -0,0 +1,387 @@
+'''
+Runs a model saved by color_svm.py over whole images and saves the predicted
+class ids as label PNGs (same names as the input images). Either the pickled
+.pth model or its .svm export can be given, the export starts much faster.
+
+In single mode the classifier is a pure function of a pixel's 24-bit color, so
+instead of predicting every pixel each color is predicted once and stored in a
+lookup table of all 256**3 colors. The table is cached on disk per model and
+only the colors it hasn't seen before get predicted, so after the first few
+images labeling an image is a single gather through the table.
+
+In area mode every pixel needs its whole neighborhood vector, which for a full
+image at once would take hundreds of MB. Images are instead cut into tiles
+(with a margin of neighbors around them) that a process pool labels, building
+and predicting the neighborhood vectors a limited number of pixels at a time,
+and the tiles are stitched back together. Per-worker memory is set with
+--worker-memory and the peak RSS and throughput are logged at the end.
+'''
+
+import argparse
+import cv2
+import hashlib
+import logging
+from multiprocessing import Pool
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+import os
+from pathlib import Path
+import resource
+import time
+
+from scripts.models.color_svm import AREA, AREA_STRIDE, CLASSES, SINGLE
+from scripts.models.svm_export import load_model
+from scripts.parallel import bounded_imap
+
+
+# Value in the lookup table for colors that haven't been predicted yet
+UNKNOWN = 255
+# Number of pixels to predict at a time
+BATCH_SIZE = 100000
+# Side length in pixels of the tiles area mode images are cut into
+TILE_SIZE = 256
+# Rough memory budget in MB for each area mode worker's predict batches
+WORKER_MEMORY = 256
+# The model each pool worker loaded, see load_worker
+WORKER = {}
+
+
+def main(modelpath, imgdir, outdir, cachedir=None, filetype="png",
+         stride=AREA_STRIDE, tile_size=TILE_SIZE, memory=WORKER_MEMORY,
+         workers=None):
+
+    classifier = load_model(modelpath)
+    mode = model_mode(classifier)
+    impaths = sorted(imgdir.glob(f"*{filetype}"))
+    start = time.time()
+    pixels = 0
+
+    if mode == SINGLE:
+        lut = color_lut(modelpath, cachedir)
+        for i, impath in enumerate(impaths):
+            image = cv2.imread(str(impath), cv2.IMREAD_UNCHANGED)
+            labels = label_single(classifier, image, lut)
+            save_labels(outdir, impath, labels)
+            pixels += labels.size
+            if i % 20 == 0:
+                logging.info(f"Labeled {impath.name}")
+        if isinstance(lut, numpy.memmap):
+            lut.flush()
+        peak = peak_rss()
+    else:
+        batch_size = predict_batch_size(classifier, memory)
+        logging.info(f"Labeling {tile_size}px tiles, predicting {batch_size}"
+                     f" pixels at a time")
+        radius = area_radius(classifier)
+        # The workers load their own copy
+        del classifier
+        peak = peak_rss()
+        with Pool(workers, initializer=load_worker, initargs=(modelpath,)) as pool:
+            for i, (impath, labels, worker_peak) in enumerate(
+                    label_area(pool, impaths, radius, stride, tile_size,
+                               batch_size, workers)):
+                save_labels(outdir, impath, labels)
+                pixels += labels.size
+                peak = max(peak, worker_peak)
+                if i % 20 == 0:
+                    logging.info(f"Labeled {impath.name}")
+
+    if len(impaths) > 0:
+        elapsed = time.time() - start
+        logging.info(f"Labeled {len(impaths)} images in {elapsed:.1f}s"
+                     f" ({elapsed / len(impaths):.2f}s per image,"
+                     f" {pixels / elapsed / 1e6:.2f} Mpixels/s),"
+                     f" peak RSS of any process {peak / 1024:.0f} MB")
+
+
+def save_labels(outdir, impath, labels):
+    '''Write a class id image to outdir under the name of its input image.'''
+    cv2.imwrite(str(outdir.joinpath(impath.with_suffix(".png").name)), labels)
+
+
+def model_mode(classifier):
+    '''The mode a model was trained in, from the number of features.'''
+    if classifier.n_features_in_ == 3:
+        return SINGLE
+    return AREA
+
+
+def area_radius(classifier):
+    '''The AREA_RADIUS an area mode model was trained with.'''
+    side = int(round(numpy.sqrt(classifier.n_features_in_ / 3)))
+    assert 3 * side**2 == classifier.n_features_in_ and side % 2 == 1, \
+        f"{classifier.n_features_in_} features isn't a square neighborhood"
+    return side // 2
+
+
+def predict_batch_size(classifier, memory):
+    '''
+    How many pixels to predict at once to stay around memory MB. Each pixel
+    costs its neighborhood vector as floats, plus a row of kernel values
+    against every support vector for kernel SVMs.
+    '''
+    per_pixel = 8 * classifier.n_features_in_
+    support = getattr(classifier, "support_vectors_", None)
+    if support is not None:
+        per_pixel += 8 * len(support)
+    # Pipelines from the approximate trainer have a kernel map in front
+    for step in getattr(classifier, "steps", []):
+        components = getattr(step[1], "n_components", None)
+        if components is not None:
+            per_pixel += 2 * 8 * components
+    return max(1, int(memory * 2**20 / (2 * per_pixel)))
+
+
+def peak_rss():
+    '''Peak resident memory of this process so far, in KB (on Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def color_lut(modelpath, cachedir=None):
+    '''
+    Lookup table from packed color to class id, filled in lazily by
+    label_single. With a cachedir it is a memory mapped .npy file keyed by the
+    model's content, so it carries over between runs.
+
+    Arguments:
+        modelpath: path to the saved model
+        cachedir: directory to keep the table in, or None to not keep it
+
+    Returns: (256**3,) uint8 array, UNKNOWN where no prediction was made yet
+    '''
+    assert max(CLASSES) < UNKNOWN
+    if cachedir is None:
+        return numpy.full(2**24, UNKNOWN, dtype=numpy.uint8)
+
+    digest = hashlib.sha256(modelpath.read_bytes()).hexdigest()
+    path = cachedir.joinpath(f"lut_{digest}.npy")
+    if not path.is_file():
+        cachedir.mkdir(parents=True, exist_ok=True)
+        # Write somewhere private and link it into place, so concurrent runs
+        # never map a half written table
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with temp_path.open("wb") as outfile:
+            numpy.save(outfile, numpy.full(2**24, UNKNOWN, dtype=numpy.uint8))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            # Someone else got there first, and may already be filling theirs
+            # in, so keep it rather than replacing it
+            pass
+        temp_path.unlink()
+    logging.info(f"Using color lookup table {path}")
+    return numpy.load(path, mmap_mode="r+")
+
+
+def label_single(classifier, image, lut):
+    '''
+    Label every pixel of an image with a single mode model, predicting only
+    the colors that aren't in the lookup table yet and adding them to it.
+
+    Arguments:
+        classifier: model trained on single pixels
+        image: (H, W, 3) uint8 image, channels in the order the model was
+            trained on (as cv2 reads them)
+        lut: lookup table from color_lut, updated in place
+
+    Returns: (H, W) uint8 image of class ids
+    '''
+    pixels = image.reshape(-1, 3).astype(numpy.uint32)
+    keys = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+    labels = lut[keys]
+
+    missing = labels == UNKNOWN
+    if missing.any():
+        new = numpy.unique(keys[missing])
+        colors = numpy.stack([new >> 16, (new >> 8) & 255, new & 255], axis=1)
+        for start in range(0, len(new), BATCH_SIZE):
+            batch = slice(start, start + BATCH_SIZE)
+            lut[new[batch]] = classifier.predict(colors[batch])
+        labels[missing] = lut[keys[missing]]
+
+    return labels.reshape(image.shape[:2])
+
+
+def label_area(pool, impaths, radius, stride, tile_size, batch_size,
+               workers=None):
+    '''
+    Label images with an area mode model tile by tile in a process pool. Only
+    a couple of tiles per worker are in flight at once, so only the image
+    being labeled (and its neighbor) are held in memory.
+
+    Arguments:
+        pool: Pool set up with load_worker
+        impaths: paths of images to label
+        radius: see AREA_RADIUS
+        stride: see AREA_STRIDE
+        tile_size: side length of the tiles, see TILE_SIZE
+        batch_size: number of pixels per predict call
+        workers: size of the pool, all cores if None
+
+    Yields: (impath, (H, W) uint8 class id image, peak worker RSS in KB)
+    '''
+    window = 2 * (workers or os.cpu_count())
+    jobs = tile_jobs(impaths, radius, stride, tile_size, batch_size)
+
+    labels = None
+    peak = 0
+    for impath, shape, row, col, tile, worker_peak in bounded_imap(
+            pool, tile_job, jobs, window):
+        if labels is None:
+            current = impath
+            labels = numpy.empty(shape, dtype=numpy.uint8)
+        elif impath != current:
+            yield current, labels, peak
+            current = impath
+            labels = numpy.empty(shape, dtype=numpy.uint8)
+        labels[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+        peak = max(peak, worker_peak)
+    if labels is not None:
+        yield current, labels, peak
+
+
+def tile_jobs(impaths, radius, stride, tile_size, batch_size):
+    '''
+    Cut images into tiles for tile_job. Each image is reflect padded first,
+    the same way color_svm.extract_patches pads for training, so every tile
+    comes with the neighbors its edge pixels need.
+    '''
+    reach = radius * stride
+    for impath in impaths:
+        image = cv2.imread(str(impath), cv2.IMREAD_UNCHANGED)
+        padded = numpy.pad(image, ((reach, reach), (reach, reach), (0, 0)),
+                           mode="reflect")
+        for row in range(0, image.shape[0], tile_size):
+            for col in range(0, image.shape[1], tile_size):
+                height = min(tile_size, image.shape[0] - row)
+                width = min(tile_size, image.shape[1] - col)
+                tile = padded[row:row + height + 2 * reach,
+                              col:col + width + 2 * reach].copy()
+                yield (impath, image.shape[:2], row, col, tile, radius,
+                       stride, batch_size)
+
+
+def load_worker(modelpath):
+    '''Pool initializer, loads the model once per worker process.'''
+    WORKER["classifier"] = load_model(modelpath)
+
+
+def tile_job(job):
+    '''
+    Label one padded tile, building the neighborhood vectors of batch_size
+    pixels at a time out of a sliding window view of the tile.
+
+    Arguments:
+        job: (impath, shape, row, col, tile, radius, stride, batch_size)
+
+    Returns: (impath, shape, row, col, (h, w) uint8 labels, peak RSS in KB)
+    '''
+    impath, shape, row, col, tile, radius, stride, batch_size = job
+    reach = radius * stride
+    # (h, w, 3, side, side) view, nothing is copied until the gather
+    windows = sliding_window_view(tile,
+                                  (2 * reach + 1, 2 * reach + 1),
+                                  axis=(0, 1))[..., ::stride, ::stride]
+    height, width = windows.shape[:2]
+    labels = numpy.empty(height * width, dtype=numpy.uint8)
+
+    # Whole rows at a time, laid out like color_svm.extract_patches
+    rows = max(1, batch_size // width)
+    for start in range(0, height, rows):
+        patches = windows[start:start + rows].transpose(0, 1, 3, 4, 2)
+        vectors = patches.reshape(len(patches) * width, -1)
+        labels[start * width:(start * width) + len(vectors)] = \
+            WORKER["classifier"].predict(vectors)
+
+    return (impath, shape, row, col, labels.reshape(height, width),
+            peak_rss())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-c", "--cache-dir",
+        help="Directory to keep the per-model color lookup tables in.",
+        default=Path("/tmp/svm_cache/"),
+        type=Path,
+    )
+    parser.add_argument(
+        "-f", "--filetype",
+        help="End of the filetype, will be searched for with *<filetype>.",
+        default="png",
+    )
+    parser.add_argument(
+        "-i", "--img-dir",
+        help="Directory with images to label.",
+        required=True,
+        type=Path,
+    )
+    parser.add_argument(
+        "-m", "--model",
+        help="Model saved by color_svm.py, .pth or .svm.",
+        required=True,
+        type=Path,
+    )
+    parser.add_argument(
+        "-n", "--tile-size",
+        help="In area mode, side length of the tiles images are labeled in.",
+        type=int,
+        default=TILE_SIZE,
+    )
+    parser.add_argument(
+        "-o", "--out-dir",
+        help="Directory to save the class id images in.",
+        required=True,
+        type=Path,
+    )
+    parser.add_argument(
+        "-r", "--worker-memory",
+        help="In area mode, rough memory budget in MB for each worker's"
+             " predict batches. Sets how many pixels are predicted at once.",
+        type=int,
+        default=WORKER_MEMORY,
+    )
+    parser.add_argument(
+        "-t", "--area-stride",
+        help="In area mode, the stride the model was trained with (the radius"
+             " is worked out from the model).",
+        type=int,
+        default=AREA_STRIDE,
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        help="In area mode, number of processes to label tiles with. Uses all"
+             " cores if not given.",
+        type=int,
+        default=None,
+    )
+    args = parser.parse_args()
+
+    assert args.img_dir.is_dir()
+    assert args.model.is_file()
+    assert args.out_dir.is_dir()
+
+    return args
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    args = parse_args()
+    main(modelpath=args.model,
+         imgdir=args.img_dir,
+         outdir=args.out_dir,
+         cachedir=args.cache_dir,
+         filetype=args.filetype,
+         stride=args.area_stride,
+         tile_size=args.tile_size,
+         memory=args.worker_memory,
+         workers=args.workers)
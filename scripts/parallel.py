@@ -0,0 +1,21 @@
+'''
+Process pool helpers shared between the scripts.
+'''
+
+from collections import deque
+
+
+def bounded_imap(pool, function, iterable, window):
+    '''
+    Like pool.imap, but only reads up to window items ahead of the results it
+    has handed back. Pool.imap drains the whole iterable as fast as it can,
+    which would defeat streaming jobs out of a big file or queueing up every
+    tile of a dataset.
+    '''
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,223 @@
+'''
+Shared stage-level instrumentation for the scripts. Profiling is turned on by
+a script's --profile flag (see add_arguments) or by setting the PROFILE_ENV
+environment variable to a report path. Once on, code wrapped in stage() is
+timed (wall and CPU) and probed for its peak traced (tracemalloc) memory and
+the process's peak RSS. At the end of the run each stage's totals are
+appended to a JSON-lines report, one line per stage plus a line for the whole
+run, and cProfile stats can optionally be dumped as well. When profiling is
+off, stage() does nothing.
+
+Pool workers forked from a profiled run record their own stages; to have
+them show up in the report, jobs return collect() and the parent passes that
+to merge().
+'''
+
+from contextlib import contextmanager, nullcontext
+from cProfile import Profile
+import json
+import os
+from pathlib import Path
+import resource
+import sys
+import time
+import tracemalloc
+
+
+# Setting this to a report path turns profiling on without the flag
+PROFILE_ENV = "SEMSEG_PROFILE"
+# Setting this to a path turns on cProfile and dumps its stats there
+CPROFILE_ENV = "SEMSEG_CPROFILE"
+# Where the report goes when --profile is given without a path
+DEFAULT_REPORT = Path("/tmp/semseg_profile.jsonl")
+
+# State of this process's profiling, see start
+STATE = {"enabled": False}
+
+
+def add_arguments(parser):
+    '''Add the --profile and --cprofile flags to an argparse parser.'''
+    parser.add_argument(
+        "--profile",
+        help="Time and memory profile the stages of the run and append them"
+             " to this JSON-lines report. Also turned on by setting"
+             f" ${PROFILE_ENV} to a report path.",
+        nargs="?",
+        const=DEFAULT_REPORT,
+        default=None,
+        type=Path,
+    )
+    parser.add_argument(
+        "--cprofile",
+        help="Also run cProfile and dump its stats to this path (for pstats"
+             f" or snakeviz). Also turned on by setting ${CPROFILE_ENV}.",
+        default=None,
+        type=Path,
+    )
+
+
+def start(script, report=None, cprofile=None):
+    '''
+    Turn profiling on for the rest of the run if a report path was given,
+    either directly or through PROFILE_ENV. The same goes for cprofile.
+
+    Arguments:
+        script: name to record the run under, usually the script's name
+        report: path of the JSON-lines report to append to, or None
+        cprofile: path to dump cProfile stats to, or None
+    '''
+    if report is None and os.environ.get(PROFILE_ENV):
+        report = Path(os.environ[PROFILE_ENV])
+    if cprofile is None and os.environ.get(CPROFILE_ENV):
+        cprofile = Path(os.environ[CPROFILE_ENV])
+    if report is None and cprofile is None:
+        return
+
+    STATE.update({
+        "enabled": report is not None,
+        "script": script,
+        "report": report,
+        "cprofile_path": cprofile,
+        "cprofile": None,
+        "pid": os.getpid(),
+        "stages": {},
+        "stack": [],
+        "start": time.time(),
+        "cpu_start": time.process_time(),
+    })
+    if STATE["enabled"]:
+        tracemalloc.start()
+    if cprofile is not None:
+        STATE["cprofile"] = Profile()
+        STATE["cprofile"].enable()
+
+
+def finish():
+    '''Write out the report and cProfile stats, if profiling was started.'''
+    if STATE.get("cprofile") is not None:
+        STATE["cprofile"].disable()
+        STATE["cprofile"].dump_stats(str(STATE["cprofile_path"]))
+    if not STATE["enabled"]:
+        return
+
+    run = {
+        "script": STATE["script"],
+        "argv": sys.argv,
+        "pid": STATE["pid"],
+        "started": STATE["start"],
+    }
+    lines = [
+        dict(run, stage=name, **totals)
+        for name, totals in STATE["stages"].items()
+    ]
+    lines.append(dict(
+        run,
+        stage="total",
+        calls=1,
+        seconds=time.time() - STATE["start"],
+        cpu_seconds=time.process_time() - STATE["cpu_start"],
+        traced_peak_mb=tracemalloc.get_traced_memory()[1] / 2**20,
+        rss_peak_mb=rss_peak_mb(),
+    ))
+    tracemalloc.stop()
+    STATE["enabled"] = False
+
+    STATE["report"].parent.mkdir(parents=True, exist_ok=True)
+    with STATE["report"].open("a") as outfile:
+        for line in lines:
+            outfile.write(json.dumps(line) + "\n")
+
+
+def stage(name):
+    '''
+    Context manager that adds the time and memory of its block to the named
+    stage. Stages can nest, and the same stage can be entered many times.
+    '''
+    if not STATE["enabled"]:
+        return nullcontext()
+    return timed_stage(name)
+
+
+@contextmanager
+def timed_stage(name):
+    # A forked worker starts out with a copy of the parent's totals, which
+    # would get counted twice if they were merged back
+    if STATE["pid"] != os.getpid():
+        STATE.update({"pid": os.getpid(), "stages": {}, "stack": []})
+
+    # tracemalloc has one peak per process, so hand whatever the enclosing
+    # stage has reached so far up to it before resetting the peak for this one
+    if STATE["stack"]:
+        STATE["stack"][-1]["peak"] = max(STATE["stack"][-1]["peak"],
+                                         tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    frame = {"peak": 0}
+    STATE["stack"].append(frame)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - wall
+        cpu_seconds = time.process_time() - cpu
+        STATE["stack"].pop()
+        peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+        if STATE["stack"]:
+            STATE["stack"][-1]["peak"] = max(STATE["stack"][-1]["peak"], peak)
+        add(name, {
+            "calls": 1,
+            "seconds": seconds,
+            "cpu_seconds": cpu_seconds,
+            "traced_peak_mb": peak / 2**20,
+            "rss_peak_mb": rss_peak_mb(),
+        })
+
+
+def profiled(name, iterable):
+    '''Iterate through iterable, counting the time spent producing each item
+    (for lazy generators, the work done for it) as the named stage.'''
+    if not STATE["enabled"]:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def collect():
+    '''Take this process's stage totals so far, to return from a pool job.'''
+    if not STATE["enabled"] or STATE["pid"] != os.getpid():
+        return {}
+    stages = STATE["stages"]
+    STATE["stages"] = {}
+    return stages
+
+
+def merge(stages):
+    '''Add stage totals from collect() in a pool worker to this process's.'''
+    for name, totals in stages.items():
+        add(name, totals)
+
+
+def add(name, totals):
+    '''Sum times and calls into a stage, and take the max of the peaks.'''
+    if not STATE["enabled"]:
+        return
+    if name not in STATE["stages"]:
+        STATE["stages"][name] = dict(totals)
+        return
+    current = STATE["stages"][name]
+    for key in ("calls", "seconds", "cpu_seconds"):
+        current[key] += totals[key]
+    for key in ("traced_peak_mb", "rss_peak_mb"):
+        current[key] = max(current[key], totals[key])
+
+
+def rss_peak_mb():
+    '''Peak resident memory of this process so far, in MB (on Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
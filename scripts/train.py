@@ -0,0 +1,423 @@
+'''
+Training data loading for the cityscapes format datasets (img_dir/<split> and
+ann_dir/<split>, as convert_data_to_unet.py makes them). Loader decodes and
+augments batches in background worker processes so a training loop doesn't
+sit waiting on PNG decoding. Batches are written straight into a small ring
+of shared memory slots, which bounds how far ahead the workers get and means
+batches never get pickled between processes.
+
+Augmentation is applied jointly to image and label: a random crop and flips
+are just views of the decoded arrays, so the only copy is into the batch
+slot, and the color jitter is a per-image lookup table applied in place.
+
+Run directly, this loops over the data like a training loop would and reports
+batches per second and how much of the time was spent waiting for data.
+'''
+
+import argparse
+import cv2
+import logging
+from multiprocessing import Process, Queue
+from multiprocessing.shared_memory import SharedMemory
+import numpy
+from pathlib import Path
+from queue import Empty
+import time
+
+from scripts import profiling
+
+
+# Side lengths (height, width) of the random crops
+CROP = (512, 512)
+# Probability of flipping an image left-right / upside down
+FLIP_HORIZONTAL = 0.5
+FLIP_VERTICAL = 0.0
+# Color jitter, each image gets a brightness gain of 1 +- GAIN_JITTER, each
+# channel a further 1 +- CHANNEL_JITTER and an offset of +- BIAS_JITTER
+GAIN_JITTER = 0.2
+CHANNEL_JITTER = 0.05
+BIAS_JITTER = 10
+
+
+def main(datapath, split="train", batch_size=8, crop=CROP, workers=4,
+         prefetch=4, epochs=1, seed=0, augment=True, step_time=0.0):
+
+    with Loader(datapath, split, batch_size, crop, workers, prefetch, seed,
+                augment) as loader:
+        logging.info(f"Loading {len(loader.pairs)} images in batches of"
+                     f" {batch_size} with {workers} workers")
+        for epoch in range(epochs):
+            start = time.time()
+            waited = 0.0
+            batches = 0
+            wait_start = time.time()
+            for images, labels in loader.epoch(epoch):
+                waited += time.time() - wait_start
+                batches += 1
+                # Stand-in for the training step
+                with profiling.stage("step"):
+                    time.sleep(step_time)
+                if batches % 20 == 0:
+                    elapsed = time.time() - start
+                    logging.info(f"Epoch {epoch} batch {batches}:"
+                                 f" {batches / elapsed:.2f} batches/s")
+                wait_start = time.time()
+
+            elapsed = time.time() - start
+            logging.info(f"Epoch {epoch}: {batches} batches in {elapsed:.1f}s,"
+                         f" {batches / elapsed:.2f} batches/s,"
+                         f" {len(loader.pairs) / elapsed:.1f} images/s,"
+                         f" {100 * waited / elapsed:.0f}% waiting on data")
+
+
+def dataset_pairs(datapath, split="train"):
+    '''
+    Returns: sorted list of (image path, label path) tuples of a split
+    '''
+    imgs = sorted(datapath.joinpath("img_dir", split).glob("*png"))
+    anns = sorted(datapath.joinpath("ann_dir", split).glob("*png"))
+    assert [path.name for path in imgs] == [path.name for path in anns], \
+        f"Images and labels in {datapath} ({split}) don't match up"
+    return list(zip(imgs, anns))
+
+
+class Loader:
+    '''
+    Iterates over shuffled, augmented batches of a dataset split, which
+    worker processes prepare ahead of time.
+
+    Each batch is yielded as (images, labels) arrays of shape (B, H, W, 3)
+    uint8 and (B, H, W) uint8. They are views into shared memory that gets
+    reused, so they are only valid until the next batch is asked for or the
+    epoch is stopped (copy them to keep them). The last batch of an epoch can
+    be smaller. Batches come out in whatever order the workers finish them,
+    but what goes into each batch only depends on the seed, epoch and batch
+    number.
+
+    One epoch runs at a time, an epoch that is left early (a break, an
+    error, or starting the next one) hands its slot back and cancels the
+    batches that haven't been started. Batches of it that were already in
+    progress are tagged with its token, and dropped as they come in.
+    '''
+    def __init__(self, datapath, split="train", batch_size=8, crop=CROP,
+                 workers=4, prefetch=4, seed=0, augment=True):
+        self.pairs = dataset_pairs(datapath, split)
+        assert len(self.pairs) > 0, f"No images in {datapath} ({split})"
+        self.batch_size = batch_size
+        self.crop = tuple(crop)
+        self.seed = seed
+        self.augment = augment
+        # The epoch being iterated over, and a count of the epochs started
+        # that tags their batches
+        self.current = None
+        self.token = 0
+
+        # One slot more than the prefetch, since the consumer holds on to
+        # the batch it is working on
+        self.slots = prefetch + 1
+        self.memory = SharedMemory(create=True,
+                                   size=self.slots * slot_size(batch_size,
+                                                               self.crop))
+        self.tasks = Queue()
+        self.free = Queue()
+        self.ready = Queue()
+        for slot in range(self.slots):
+            self.free.put(slot)
+        self.workers = [
+            Process(target=loader_worker,
+                    args=(self.memory.name, batch_size, self.crop,
+                          self.pairs, augment, self.tasks, self.free,
+                          self.ready),
+                    daemon=True)
+            for _ in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def epoch(self, number):
+        '''
+        Start the batches of one pass over the dataset, shuffled by the seed
+        and epoch number, stopping the previous epoch if it isn't done.
+
+        Returns: generator of (images, labels) batches
+        '''
+        if self.current is not None:
+            self.current.close()
+        self.current = self.batches(number)
+        return self.current
+
+    def batches(self, number):
+        '''Generator behind epoch.'''
+        self.token += 1
+        token = self.token
+        order = numpy.random.default_rng([self.seed, number]) \
+            .permutation(len(self.pairs))
+        batches = [order[start:start + self.batch_size]
+                   for start in range(0, len(order), self.batch_size)]
+        for i, indices in enumerate(batches):
+            self.tasks.put((token, indices, [self.seed, number, i]))
+
+        held = None
+        received = 0
+        try:
+            while received < len(batches):
+                with profiling.stage("wait"):
+                    batch_token, slot, size, error = self.ready.get()
+                if batch_token != token:
+                    # Left over from an epoch that was stopped early
+                    self.free.put(slot)
+                    continue
+                received += 1
+                if held is not None:
+                    self.free.put(held)
+                    held = None
+                if error is not None:
+                    self.free.put(slot)
+                    raise RuntimeError(f"Loader worker failed: {error}")
+                held = slot
+                images, labels = slot_arrays(self.memory.buf, slot,
+                                             self.batch_size, self.crop)
+                yield images[:size], labels[:size]
+        finally:
+            if held is not None:
+                self.free.put(held)
+            # Take back the batches no worker has started on. Anything that
+            # is missed here gets dropped by its token like the ones in
+            # progress
+            if received < len(batches):
+                try:
+                    while True:
+                        self.tasks.get_nowait()
+                except Empty:
+                    pass
+
+    def close(self):
+        '''Stop the workers and free the shared memory.'''
+        if self.current is not None:
+            self.current.close()
+        # A worker is either waiting for a task or, holding one, for a free
+        # slot, so send a stop to both
+        for _ in self.workers:
+            self.tasks.put(None)
+            self.free.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        try:
+            self.memory.close()
+        except BufferError:
+            # The caller still has a batch view, the memory goes when it does
+            pass
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def loader_worker(name, batch_size, crop, pairs, augment, tasks, free, ready):
+    '''
+    Worker process for Loader. Takes (token, indices, seed) batch tasks,
+    waits for a free slot and fills it in, until it gets None for either.
+    '''
+    memory = SharedMemory(name=name)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            token, indices, seed = task
+            slot = free.get()
+            if slot is None:
+                break
+            try:
+                images, labels = slot_arrays(memory.buf, slot, batch_size,
+                                             crop)
+                rng = numpy.random.default_rng(seed)
+                for i, index in enumerate(indices):
+                    load_sample(pairs[index], images[i], labels[i], rng,
+                                augment)
+            except Exception as error:
+                ready.put((token, slot, 0, repr(error)))
+                continue
+            ready.put((token, slot, len(indices), None))
+    finally:
+        # The views into the buffer have to go before it can be closed
+        images = labels = None
+        memory.close()
+
+
+def slot_size(batch_size, crop):
+    '''Bytes of shared memory one batch takes.'''
+    return batch_size * crop[0] * crop[1] * 4
+
+
+def slot_arrays(buffer, slot, batch_size, crop):
+    '''
+    Views of one batch slot in the shared memory.
+
+    Returns: (B, H, W, 3) uint8 images and (B, H, W) uint8 labels
+    '''
+    start = slot * slot_size(batch_size, crop)
+    pixels = batch_size * crop[0] * crop[1]
+    images = numpy.ndarray((batch_size,) + tuple(crop) + (3,),
+                           dtype=numpy.uint8, buffer=buffer, offset=start)
+    labels = numpy.ndarray((batch_size,) + tuple(crop),
+                           dtype=numpy.uint8, buffer=buffer,
+                           offset=start + 3 * pixels)
+    return images, labels
+
+
+def load_sample(pair, image_out, label_out, rng, augment=True):
+    '''
+    Decode one image/label pair, and write a random crop of it (flipped and
+    color jittered if augmenting) into the given output arrays. Without
+    augmenting, the crop is taken from the top left corner.
+
+    Arguments:
+        pair: (image path, label path)
+        image_out: (H, W, 3) uint8 array to write the image crop into
+        label_out: (H, W) uint8 array to write the label crop into
+        rng: numpy.random.Generator for the augmentation
+        augment: whether to randomize the crop and apply flips and jitter
+    '''
+    image = cv2.imread(str(pair[0]), cv2.IMREAD_COLOR)
+    label = cv2.imread(str(pair[1]), cv2.IMREAD_UNCHANGED)
+    assert image.shape[:2] == label.shape, f"{pair} don't match in size"
+    height, width = label_out.shape
+    assert label.shape[0] >= height and label.shape[1] >= width, \
+        f"{pair[0]} {label.shape} is smaller than the crop {label_out.shape}"
+
+    row = col = 0
+    if augment:
+        row = rng.integers(0, label.shape[0] - height + 1)
+        col = rng.integers(0, label.shape[1] - width + 1)
+    # Everything up to the copy into the outputs is a view
+    image = image[row:row + height, col:col + width]
+    label = label[row:row + height, col:col + width]
+    if augment:
+        if rng.random() < FLIP_HORIZONTAL:
+            image = image[:, ::-1]
+            label = label[:, ::-1]
+        if rng.random() < FLIP_VERTICAL:
+            image = image[::-1]
+            label = label[::-1]
+    image_out[:] = image
+    label_out[:] = label
+
+    if augment:
+        cv2.LUT(image_out, jitter_table(rng), dst=image_out)
+
+
+def jitter_table(rng):
+    '''
+    Random color jitter as a lookup table, so applying it is a single pass
+    over the uint8 image with no float copy.
+
+    Returns: (256, 1, 3) uint8 table for cv2.LUT
+    '''
+    gain = 1 + rng.uniform(-GAIN_JITTER, GAIN_JITTER)
+    gains = gain * (1 + rng.uniform(-CHANNEL_JITTER, CHANNEL_JITTER, size=3))
+    bias = rng.uniform(-BIAS_JITTER, BIAS_JITTER, size=3)
+    values = numpy.arange(256)[:, None] * gains + bias
+    return numpy.clip(numpy.rint(values), 0, 255) \
+        .astype(numpy.uint8).reshape(256, 1, 3)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-b", "--batch-size",
+        help="Number of images per batch.",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "-c", "--crop",
+        help="Height and width of the random crops.",
+        nargs=2,
+        type=int,
+        default=list(CROP),
+    )
+    parser.add_argument(
+        "-d", "--data-path",
+        help="Base folder in the cityscapes format from which to draw images.",
+        required=True,
+        type=Path,
+    )
+    parser.add_argument(
+        "-e", "--epochs",
+        help="Number of passes over the data.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-f", "--prefetch",
+        help="Most batches the workers can get ahead by. Bounds the memory.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "-n", "--no-augment",
+        help="Take plain top left crops, no flips or jitter.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-p", "--seed",
+        help="Seed for the shuffling and augmentation.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "-s", "--split",
+        help="Which split to load.",
+        default="train",
+    )
+    parser.add_argument(
+        "-t", "--step-time",
+        help="Seconds to sleep per batch, standing in for a training step.",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of loader processes.",
+        type=int,
+        default=4,
+    )
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    assert args.data_path.joinpath("img_dir", args.split).is_dir()
+    assert args.prefetch >= 1
+
+    return args
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    args = parse_args()
+    profiling.start("train", args.profile, args.cprofile)
+    main(datapath=args.data_path,
+         split=args.split,
+         batch_size=args.batch_size,
+         crop=args.crop,
+         workers=args.workers,
+         prefetch=args.prefetch,
+         epochs=args.epochs,
+         seed=args.seed,
+         augment=not args.no_augment,
+         step_time=args.step_time)
+    profiling.finish()